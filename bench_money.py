@@ -0,0 +1,260 @@
+"""
+    Benchmarks of make_money.py: time, peak memory, output size and write throughput
+    of the generation stages, for several job sizes and page layouts.
+"""
+#!/usr/bin/python
+
+import os
+from pathlib import Path
+import io
+import sys
+import time
+import json
+import shlex
+import tempfile
+import argparse
+import tracemalloc
+import platform
+from contextlib import redirect_stdout
+from collections import deque
+
+import make_money
+
+# bills per page, columns
+LAYOUTS = [(6, 2), (10, 2), (81, 9)]
+
+# bill values of the default set, the pages are spread over them
+BILL_VALUES = [1, 5, 10, 20, 50, 100, 500]
+
+# stages that write a file, their write throughput is shown
+FILE_STAGES = ('create_tex_main', 'create_printable_doc')
+
+
+def argumentparser():
+    """ ArgumentParser """
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(__file__),
+        description='** Board Game Money-Maker benchmarks ** Runs the stages of make_money.py '\
+            'for every job size and layout and prints time, peak memory and output size.',
+        allow_abbrev=False)
+
+    parser.add_argument('-sizes', metavar='N', type=int, nargs='+', \
+        default=[100, 10000, 1000000], help='Number of bills of the jobs (rounded up to '\
+        'full pages). Default: %(default)s')
+    parser.add_argument('-layouts', metavar='BPP:COL', type=str, nargs='+', \
+        default=[f'{bpp}:{col}' for bpp, col in LAYOUTS], help='Bills per page and columns. '\
+        'Default: %(default)s')
+    parser.add_argument('-e2e', action='store_true', default=False, \
+        help='Also make the whole money set (make_money.build), with a stub instead of '\
+        'lualatex, so no LaTeX installation is needed; once as is and once with -embedeach, '\
+        'to compare (with -engine lualatex) file size and time with an image embedded '\
+        'once or for every bill. (Default: %(default)s)')
+    parser.add_argument('-engine', metavar='CMD', type=str, default=None, \
+        help='Use this engine for -e2e instead of the stub, e.g. lualatex. '\
+        'Default: the stub')
+    parser.add_argument('-nomem', action='store_true', default=False, \
+        help='Don\'t measure the peak memory (tracemalloc makes the stages several '\
+        'times slower, which adds up with 10^6 bills). (Default: %(default)s)')
+    parser.add_argument('-save', metavar='FILE', type=str, default=None, \
+        help='Write the results to FILE (JSON), as baseline for -compare. Default: %(default)s')
+    parser.add_argument('-compare', metavar='FILE', type=str, default=None, \
+        help='Compare the results with those in FILE. Exits with 1 if a stage is slower, '\
+        'needs more memory or writes more than -tolerance allows. Default: %(default)s')
+    parser.add_argument('-tolerance', metavar='float', type=float, default=0.25, \
+        help='Allowed increase for -compare (0.25 = 25%%). Default: %(default)s')
+    parser.add_argument('-minseconds', metavar='float', type=float, default=0.01, \
+        help='-compare ignores the time of stages faster than this (too noisy). '\
+        'Default: %(default)s')
+    parser.add_argument('-stubengine', action='store_true', default=False, \
+        help=argparse.SUPPRESS)
+
+    return parser
+
+
+def stub_engine(argv):
+    """
+        Stands in for lualatex: writes an empty one page pdf, a log and an aux file for
+        the tex file (last argument) into -output-directory. Like lualatex, the aux file
+        of a tex file with tikz overlays changes after the first run.
+    """
+    texfile = Path(argv[-1])
+    outdir = Path(argv[argv.index('-output-directory') + 1])
+    stem = outdir/texfile.stem
+
+    pdf = make_money.PdfWriter(stem.with_suffix('.pdf'))
+    pdf.add_page(595, 842, b'', pdf.image(None))
+    pdf.close()
+
+    marks = b''
+    if b'remember picture' in texfile.read_bytes():
+        marks = b'\\pgfsyspdfmark {pgfid1}{0}{0}\n'
+    stem.with_suffix('.aux').write_bytes(marks)
+    stem.with_suffix('.log').write_bytes(b'This is a stub engine.\n')
+    return 0
+
+
+def get_pages(bills, bpp):
+    """
+        Bill values and their number of pages for (at least) bills bills
+    """
+    pages = -(-bills // bpp)
+    values = BILL_VALUES[:pages]
+    nop = [pages // len(values) + (1 if i < pages % len(values) else 0) \
+        for i in range(len(values))]
+    return values, nop
+
+
+def get_config(bills, bpp, col, workdir, **settings):
+    """
+        Validated settings for a job of (at least) bills bills
+    """
+    values, nop = get_pages(bills, bpp)
+    config = make_money.Config(bv=values, nop=nop, bpp=bpp, col=col, sns=1234, **settings)
+    make_money.args_validator(config, make_money.get_defaults())
+    config.images = {}
+    config.progress = make_money.Progress(rate=0)
+    config.workdir = Path(workdir)
+    return config
+
+
+def measure(func, memory=True):
+    """
+        Runs func for the time and, if memory, once more with tracemalloc for the
+        peak memory. Returns (seconds, peak KiB or None, result of func).
+    """
+    with open(os.devnull, 'w', encoding='utf8') as devnull, redirect_stdout(devnull):
+        tstart = time.perf_counter()
+        result = func()
+        seconds = time.perf_counter() - tstart
+
+        if not memory:
+            return seconds, None, result
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return seconds, peak / 1024, result
+
+
+def bench_stages(bills, bpp, col, workdir, memory):
+    """
+        Time, memory and output size of the stages of one job. Returns {stage: result}.
+    """
+    # pylint: disable=too-many-locals
+    config = get_config(bills, bpp, col, workdir)
+    results = {}
+
+    def serials():
+        # a SerialStream only computes the serials when they are read
+        lstserial = make_money.get_random_list(config)
+        deque(lstserial, maxlen=0)
+        return lstserial
+    seconds, peak, lstserial = measure(serials, memory)
+    results['get_random_list'] = (seconds, peak, 0)
+
+    texfile = Path(workdir)/'1-main.tex'
+    seconds, peak, _ = measure(lambda: make_money.create_tex_main(config, texfile, lstserial), \
+        memory)
+    results['create_tex_main'] = (seconds, peak, texfile.stat().st_size)
+
+    def preamble():
+        make_money._PREAMBLES.clear() # pylint: disable=protected-access
+        out = io.StringIO()
+        make_money.get_serialnumber_setting(config, out)
+        return out.getvalue()
+    seconds, peak, text = measure(preamble, memory)
+    results['get_serialnumber_setting'] = (seconds, peak, len(text.encode('utf8')))
+
+    units = make_money.plan_units(config)
+    pdfs = {unit.name: unit.name + '.pdf' for unit in units}
+    printfile = Path(workdir)/'2-print.tex'
+    seconds, peak, _ = measure(lambda: make_money.create_printable_doc(config, units, \
+        printfile, pdfs), memory)
+    results['create_printable_doc'] = (seconds, peak, printfile.stat().st_size)
+    return results
+
+
+def bench_e2e(bills, bpp, col, workdir, engine, **settings):
+    """
+        Time and output size of make_money.build for one job (with settings)
+    """
+    name = '-'.join(['e2e'] + sorted(settings))
+    output = Path(workdir)/(name + '.pdf')
+    values, nop = get_pages(bills, bpp)
+    config = make_money.Config(bv=values, nop=nop, bpp=bpp, col=col, sns=1234, \
+        engine=engine, out=str(output), **settings)
+    with open(os.devnull, 'w', encoding='utf8') as devnull, redirect_stdout(devnull):
+        tstart = time.perf_counter()
+        make_money.build(config, Path(workdir)/name)
+        seconds = time.perf_counter() - tstart
+    return seconds, None, output.stat().st_size
+
+
+def compare(results, file_baseline, tolerance, minseconds):
+    """
+        Prints the changes against the baseline. Returns the number of regressions.
+    """
+    with open(file_baseline, 'r', encoding='utf8') as json_file:
+        baseline = json.load(json_file)['results']
+
+    print('')
+    print(f'Compared with {file_baseline} (tolerance {tolerance:.0%}):')
+    regressions = 0
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for key in ('seconds', 'peak_kib', 'bytes'):
+            old, new = baseline[name].get(key), result.get(key)
+            if not old or new is None or (key == 'seconds' and max(old, new) < minseconds):
+                continue
+            change = new / old - 1
+            if change > tolerance:
+                regressions += 1
+                print(f'  WORSE   {name} {key}: {old:.4g} -> {new:.4g} ({change:+.0%})')
+            elif change < -tolerance:
+                print(f'  better  {name} {key}: {old:.4g} -> {new:.4g} ({change:+.0%})')
+    print(f'  {regressions} regression(s)')
+    return regressions
+
+
+def main(args):
+    """
+        MAIN
+    """
+    engine = args.engine or shlex.join([sys.executable, os.path.abspath(__file__), \
+        '-stubengine'])
+    results = {}
+    print(f"{'stage':<26}{'bills':>9}{'bpp:col':>9}{'time [s]':>11}{'peak [KiB]':>12}"\
+        f"{'output [B]':>13}{'MiB/s':>9}")
+    for bills in args.sizes:
+        for layout in args.layouts:
+            bpp, col = (int(value) for value in layout.split(':'))
+            with tempfile.TemporaryDirectory() as workdir:
+                stages = bench_stages(bills, bpp, col, workdir, not args.nomem)
+                if args.e2e:
+                    stages['build (e2e)'] = bench_e2e(bills, bpp, col, workdir, engine)
+                    stages['build (e2e, -embedeach)'] = bench_e2e(bills, bpp, col, workdir, \
+                        engine, embedeach=True)
+            for stage, (seconds, peak, size) in stages.items():
+                rate = size / 2**20 / seconds if stage in FILE_STAGES and seconds else None
+                results[f'{stage} bills={bills} layout={layout}'] = {'seconds': seconds, \
+                    'peak_kib': peak, 'bytes': size, 'mib_per_s': rate}
+                print(f"{stage:<26}{bills:>9}{layout:>9}{seconds:>11.4f}"\
+                    f"{'-' if peak is None else f'{peak:.0f}':>12}{size:>13}"\
+                    f"{'-' if rate is None else f'{rate:.1f}':>9}")
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf8') as json_file:
+            json.dump({'created': time.strftime('%Y-%m-%dT%H:%M:%S'), \
+                'python': platform.python_version(), 'machine': platform.machine(), \
+                'results': results}, json_file, indent=2)
+        print(f'Results written to {args.save}')
+
+    if args.compare and compare(results, args.compare, args.tolerance, args.minseconds):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    if '-stubengine' in sys.argv:
+        sys.exit(stub_engine(sys.argv[1:]))
+    main(argumentparser().parse_args())
@@ -2,23 +2,83 @@
     Make your own Board-Game Money
 """
 #!/usr/bin/python
+# one script on purpose; imports that only some runs need are made where they're used,
+# so that importing make_money stays fast
+# pylint: disable=too-many-lines,import-outside-toplevel
 
-from asyncio.windows_events import NULL
 import os
+import errno
 from pathlib import Path
-import codecs
-import subprocess
-from shutil import copyfile
-import argparse
-from collections import deque
+import copy
+import io
+import time
+import math
+import mmap
+import struct
+import zlib
+import threading
+from contextlib import contextmanager
+from shutil import copyfile, rmtree
+from collections import namedtuple, deque
+from array import array
+from itertools import islice
 import random
 import sys
 
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+
 # define files
 DIR_PATH = Path(__file__).resolve().parent
 
 MAXIMUM = 2**31 - 1 # 2147483647
 
+# lualatex is run until nothing changes anymore, but at most this many times
+MAX_LUALATEX_RUNS = 3
+
+# loops over bills ask args.progress for an update every this many bills
+PROGRESS_STEP = 1024
+
+# log file messages asking for another run
+RERUN_MARKERS = (b'Rerun to get', b'Rerun LaTeX', b'(rerunfilecheck)')
+
+# log file messages of a run that ran out of memory
+CAPACITY_MARKERS = (b'TeX capacity exceeded', b'not enough memory')
+
+# paper sizes of the geometry package: (width, height) in mm, portrait
+PAPER_SIZES = dict([('a0paper', (841, 1189)), ('a1paper', (594, 841)), \
+    ('a2paper', (420, 594)), ('a3paper', (297, 420)), ('a4paper', (210, 297)), \
+    ('a5paper', (148, 210)), ('a6paper', (105, 148)), ('b0paper', (1000, 1414)), \
+    ('b1paper', (707, 1000)), ('b2paper', (500, 707)), ('b3paper', (353, 500)), \
+    ('b4paper', (250, 353)), ('b5paper', (176, 250)), ('b6paper', (125, 176)), \
+    ('c0paper', (917, 1297)), ('c1paper', (648, 917)), ('c2paper', (458, 648)), \
+    ('c3paper', (324, 458)), ('c4paper', (229, 324)), ('c5paper', (162, 229)), \
+    ('c6paper', (114, 162)), ('b0j', (1030, 1456)), ('b1j', (728, 1030)), \
+    ('b2j', (515, 728)), ('b3j', (364, 515)), ('b4j', (257, 364)), ('b5j', (182, 257)), \
+    ('b6j', (128, 182)), ('ansiapaper', (215.9, 279.4)), ('ansibpaper', (279.4, 431.8)), \
+    ('ansicpaper', (431.8, 558.8)), ('ansidpaper', (558.8, 863.6)), \
+    ('ansiepaper', (863.6, 1117.6)), ('letterpaper', (215.9, 279.4)), \
+    ('executivepaper', (184.15, 266.7)), ('legalpaper', (215.9, 355.6))])
+
+# file extensions graphicx tries (in this order) for lualatex, if none is given
+IMAGE_EXTENSIONS = ('.pdf', '.png', '.jpg', '.jpeg', '.PDF', '.PNG', '.JPG', '.JPEG')
+
+# A part of the bills document that is compiled on its own: 'pages' pages (= printed
+# sheets) starting at page 'first' (zero-based, over all bill values). 'index' is the
+# bill value (index in -bv) of all its bills, or None if it may contain several values.
+BillUnit = namedtuple('BillUnit', 'name index first pages')
+
+# What the header of an image says: kind ('png', 'jpeg' or 'pdf'), width and height
+# (pixels, pt for pdf) and resolution (dpi), None if it doesn't say
+ImageInfo = namedtuple('ImageInfo', 'kind width height dpi interlaced')
+
 LIST_OF_FONTS = dict([('Apicturealphabet', r'\ECFAPictureAlphabet'), \
     ('Augie', r'\ECFAugie'), \
     ('Decadence', r'\ECFDecadence'), \
@@ -45,8 +105,16 @@ LIST_OF_FONTS = dict([('Apicturealphabet', r'\ECFAPictureAlphabet'), \
     ('Teenspirit', r'\ECFTeenSpirit'), \
     ('Webster', r'\ECFWebster')])
 
-def argumentparser():
-    """ ArgumentParser """
+_PARSER = None
+
+def get_parser():
+    """ ArgumentParser, made on first use """
+    # pylint: disable=too-many-statements
+    global _PARSER # pylint: disable=global-statement
+    if _PARSER is not None:
+        return _PARSER
+
+    import argparse
     parser = argparse.ArgumentParser(
         prog=os.path.basename(__file__),
         description='** Board Game Money-Maker ** Make your own custom money for your favorite ' \
@@ -56,7 +124,7 @@ def argumentparser():
         epilog='NOTE: '\
             'Best results are with complete rows and columns '\
             '(i.e.: 81 bpp = 9x9, 6 bpp = 2x3, etc.). If a row is incomplete, '\
-            'it can happen that the serial numbers won\'t match anymore!')
+            'the missing bills are left blank.')
 
     parser.add_argument('-d', action='store_true', default=False, \
     help='For debugging or testing only! Use the dummy image in the subdirectory, rather than ' \
@@ -69,12 +137,7 @@ def argumentparser():
         '(Default: %(default)s)')
 
     grp_page = parser.add_argument_group('Page and bill settings')
-    list_of_paper_formats = ['a0paper', 'a1paper', 'a2paper', 'a3paper', 'a4paper', 'a5paper', \
-        'a6paper', 'b0paper', 'b1paper', 'b2paper', 'b3paper', 'b4paper', 'b5paper', 'b6paper', \
-        'c0paper', 'c1paper', 'c2paper', 'c3paper', 'c4paper', 'c5paper', 'c6paper', 'b0j', \
-        'b1j', 'b2j', 'b3j', 'b4j', 'b5j', 'b6j', 'ansiapaper', 'ansibpaper', 'ansicpaper', \
-        'ansidpaper', 'ansiepaper', 'letterpaper', 'executivepaper', 'legalpaper']
-    grp_page.add_argument('-ps', metavar='str', type=str, choices=list_of_paper_formats, \
+    grp_page.add_argument('-ps', metavar='str', type=str, choices=PAPER_SIZES.keys(), \
         default='a4paper', help='Printed paper size (page for printing is set to landscape). ' \
         'Type "-ps ?" for a list of options. Default: %(default)s')
     grp_page.add_argument('-bpp', metavar='int', type=int, default=6, help='Number of bills '\
@@ -115,6 +178,15 @@ def argumentparser():
     grp_sn.add_argument('-sn', nargs=2, metavar=('START', 'END'), default=(1, MAXIMUM), \
         type=int, help='Start and end value of serial number. Minimum = 1, Maximum = ' + \
         str(format(MAXIMUM, ',')).replace(',', "'") + ', default: %(default)s.')
+    grp_sn.add_argument('-snlegacy', action='store_true', default=False, \
+        help='Draw serial numbers the way older versions did. Reproduces the serial numbers '\
+        'of earlier runs with the same seed, but is slow for large jobs. (Default: %(default)s)')
+    grp_sn.add_argument('-registry', metavar='FILE', type=str, default=None, \
+        help='Serial number registry of a money set. Serial numbers already in FILE are '\
+        'not used again, those of this run are added to it once the pdf is written. Use '\
+        'the same FILE for all runs of a set (top-ups, other -sns). FILE has one bit per '\
+        'serial number (256 MiB, sparse where the file system allows it). '\
+        'Default: %(default)s')
     grp_sn.add_argument('-snoff', nargs=2, metavar=('X', 'Y'), default=('-44', '-0.2'), \
         type=float, help='X Y offset, in mm and starting from the center, of serial number '\
         'label (default: %(default)s mm)')
@@ -161,8 +233,154 @@ def argumentparser():
         help='Use recommended number of pages of each bill value (see above). '\
         'This will override both of the above settings. (Default: %(default)s)')
 
+    grp_reprint = parser.add_argument_group('Print some sheets again',
+        'Use the same settings (and -sns) as the first time. Only the bills on those '\
+        'sheets are made again, with the same serial numbers and at the same places.')
+    grp_reprint.add_argument('-pages', '--pages', metavar='LIST', type=str, default=None, \
+        help='Pages of yourMoney.pdf (both sides of a sheet are printed again), '\
+        'e.g. 37-38 or 3,7-9. Default: %(default)s')
+    grp_reprint.add_argument('-bills', '--bills', metavar='LIST', type=str, default=None, \
+        help='Bills (counted over the whole job, from 1) whose sheets are printed again. '\
+        'Default: %(default)s')
+
+    grp_build = parser.add_argument_group('Build settings')
+    grp_build.add_argument('-profile', '--profile', action='store_true', default=False, \
+        help='Print wall and CPU time, peak memory and bytes written of every stage. '\
+        '(Default: %(default)s)')
+    grp_build.add_argument('-profilejson', '--profile-json', metavar='FILE', type=str, \
+        default=None, dest='profilejson', help='Also write the profile as JSON to FILE '\
+        '(implies -profile). Default: %(default)s')
+    grp_build.add_argument('-events', metavar='FILE', type=str, default=None, \
+        help='Report the progress as JSON lines to FILE (- = the console) instead of '\
+        'progress bars, e.g. for a dashboard: {"time": 1.5, "out": "yourMoney.pdf", '\
+        '"event": "progress", "task": "lualatex 1-main", "done": 120, "total": 504}. '\
+        'Default: %(default)s')
+    grp_build.add_argument('-progressrate', metavar='float', type=float, default=4, \
+        help='Most progress updates per second of each task (serial numbers, writing '\
+        'the bills, every lualatex run). 0 = only when a task is done. '\
+        'Default: %(default)s')
+    grp_build.add_argument('-cache', action='store_true', default=False, \
+        help='Compile every bill value on its own and keep the result in the cache folder. '\
+        'Bill values whose settings, serial numbers and images did not change since the '\
+        'last run are not compiled again. (Default: %(default)s)')
+    grp_build.add_argument('-cachedir', metavar='str', type=str, default='cache', \
+        help='Cache folder for -cache. Default: %(default)s')
+    grp_build.add_argument('-onepass', action='store_true', default=False, \
+        help='Place images and serial numbers relative to the page (shipout hook) instead '\
+        'of tikz overlays. The bills are then compiled in one lualatex run instead of two. '\
+        'Requires LaTeX 2020-10 or newer. (Default: %(default)s)')
+    grp_build.add_argument('-backend', metavar='str', type=str, default='latex', \
+        choices=['latex', 'pdf'], help='How the bills are made. "latex": with lualatex. '\
+        '"pdf": written directly by this script, which is much faster. It only supports '\
+        'PNG and JPEG images and prints the serial number in Times-Roman (-font is ignored). '\
+        'The bills are still put on the paper with lualatex, unless -direct is set. '\
+        '-cache and -j have no effect. Default: %(default)s')
+    grp_build.add_argument('-direct', action='store_true', default=False, \
+        help='Put the bills on the paper right away, instead of making a document with one '\
+        'bill per page first and putting those pages on paper in a second lualatex job '\
+        '(2-print.tex). With "-backend pdf", lualatex is not used at all. Requires LaTeX '\
+        '2020-10 or newer. (Default: %(default)s)')
+    grp_build.add_argument('-embedeach', action='store_true', default=False, \
+        help='Embed the image again for every bill, as older versions did (only to compare '\
+        'file size and speed). Default: every image is embedded only once. '\
+        '(Default: %(default)s)')
+    grp_build.add_argument('-dpi', metavar='int', type=int, default=0, \
+        help='Scale PNG and JPEG images that are larger down to this resolution at the '\
+        'size of the bill (-width, -height), before they are used. The scaled images are '\
+        'kept in the folder "images" of -cachedir. Requires Pillow. 0 = use the images as '\
+        'they are. Default: %(default)s')
+    grp_build.add_argument('-imgquality', metavar='int', type=int, default=0, \
+        help='With -dpi: also save the images as JPEG of this quality (1-95). Images '\
+        'with transparency stay PNG. 0 = PNG. Default: %(default)s')
+    grp_build.add_argument('-format', action='store_true', default=False, \
+        help='Compile with a LuaLaTeX format of the preamble (packages, fonts, \\mypics), '\
+        'made once for every preamble and kept in the cache folder, instead of loading the '\
+        'packages in every lualatex run. If no format can be made, the files are compiled '\
+        'as usual. (Default: %(default)s)')
+    grp_build.add_argument('-maxpages', metavar='int', type=int, default=10000, \
+        help='Most pages of bills (two per bill) compiled in one lualatex run. Larger '\
+        'jobs are split, so that TeX doesn\'t run out of memory. If it does anyway, the '\
+        'part is split in two and compiled again. 0 = no limit. Default: %(default)s')
+    grp_build.add_argument('-engine', metavar='CMD', type=str, default='lualatex', \
+        help='Command to compile the tex files with, e.g. a lualatex that isn\'t on the '\
+        'PATH, or a stub for tests and benchmarks. Default: %(default)s')
+    grp_build.add_argument('-j', metavar='int', type=int, default=1, \
+        help='Number of lualatex processes to run at the same time. The bills are split '\
+        'by bill value and page range into that many parts (or more), which are compiled '\
+        'in parallel. 0 = one per CPU. Default: %(default)s')
+    grp_build.add_argument('-out', metavar='FILE', type=str, default='yourMoney.pdf', \
+        help='The pdf to write. Default: %(default)s')
+    grp_build.add_argument('-workdir', metavar='str', type=str, default=None, \
+        help='Folder for the intermediate files, e.g. /dev/shm to keep them in memory. '\
+        'Every run gets a folder of its own in there, so runs at the same time don\'t get '\
+        'in each other\'s way. It is removed when the run is done (and kept if it '\
+        'failed). Default: the temp folder of the system')
+    grp_build.add_argument('-chunk', metavar='int', type=int, default=0, \
+        help='Write the money in parts of this many sheets (yourMoney-001.pdf, '\
+        'yourMoney-002.pdf, ...). Every part is compiled on its own and written as soon '\
+        'as it and all parts before it are done, so printing can start early. '\
+        '0 = one file. Default: %(default)s')
+    grp_build.add_argument('-spool', metavar='str', type=str, default=None, \
+        help='Folder to put the finished pdf(s) in, e.g. the one a printer watches. A '\
+        'file shows up there only when it is complete. Default: next to -out')
+    grp_build.add_argument('-batch', '--batch', metavar='FILE', type=str, default=None, \
+        help='Make many money sets: FILE (JSON, or TOML with Python 3.11+) has a list '\
+        '"jobs" of settings (option names without "-", e.g. {"name": "hp", "bv": [1, 5], '\
+        '"nop": [2, 2]}) and optional "defaults" for all jobs. Every job writes NAME.pdf '\
+        '(or its "out"). All other options on the command line are ignored. '\
+        'Default: %(default)s')
+    grp_build.add_argument('-batchjobs', metavar='int', type=int, default=2, \
+        help='Number of -batch jobs to run at the same time (each with its own -j). '\
+        'Default: %(default)s')
+    grp_build.add_argument('-serve', metavar='ADDR', type=str, default=None, \
+        help='Keep running and make money sets for HTTP requests on ADDR ([HOST:]PORT, '\
+        'or the path of a Unix socket). POST /build with the settings of a -batch job as '\
+        'JSON body returns the pdf. Images and preambles are kept between requests. '\
+        'All other options on the command line are ignored. Default: %(default)s')
+    grp_build.add_argument('-servejobs', metavar='int', type=int, default=2, \
+        help='Number of -serve requests to work on at the same time. Default: %(default)s')
+    grp_build.add_argument('-servequeue', metavar='int', type=int, default=8, \
+        help='Number of -serve requests that may wait for their turn. More are refused '\
+        '(503). Default: %(default)s')
+
+    grp_dist = parser.add_argument_group('Make the money on several machines',
+        'The sheets are split into tasks in a folder all machines can reach. Workers '\
+        '(python make_money.py -worker DIR) make the sheets of a task each, the '\
+        'coordinator (-distribute DIR) puts them together. Paths like -folder are '\
+        'relative to make_money.py on every machine; -engine, -workdir, -j, -cache, '\
+        '-format, -maxpages and the progress and profile options are the worker\'s own.')
+    grp_dist.add_argument('-distribute', metavar='DIR', type=str, default=None, \
+        help='Split this money set into tasks in DIR, wait for the workers and write '\
+        'the pdf. Default: %(default)s')
+    grp_dist.add_argument('-worker', metavar='DIR', type=str, default=None, \
+        help='Make the tasks in DIR until there are none left. Default: %(default)s')
+    grp_dist.add_argument('-distsheets', metavar='int', type=int, default=50, \
+        help='Sheets per task. Default: %(default)s')
+    grp_dist.add_argument('-distworkers', metavar='int', type=int, default=0, \
+        help='Workers the coordinator starts on this machine (more can join from '\
+        'others). Default: %(default)s')
+    grp_dist.add_argument('-distlease', metavar='float', type=float, default=600, \
+        help='Seconds a worker has to show it is still alive. Tasks of workers that '\
+        'don\'t are given to others. Default: %(default)s')
+    grp_dist.add_argument('-distretries', metavar='int', type=int, default=2, \
+        help='How many times a task that failed is tried again. Default: %(default)s')
+
+    _PARSER = parser
+    return parser
+
+
+def get_defaults():
+    """
+        Default value of every setting
+    """
+    return vars(get_parser().parse_args([]))
+
+
+def argumentparser(argv=None):
+    """ ArgumentParser """
+    parser = get_parser()
     try:
-        args = parser.parse_args()
+        args = parser.parse_args(argv)
 
         # To get all defaults:
         all_defargs = {}
@@ -173,7 +391,34 @@ def argumentparser():
 
     except IOError as msg:
         parser.error(str(msg))
-        return NULL
+        return None
+
+
+class Config:
+    """
+        Settings of a money set, for build(). These are the defaults of the command
+        line options, changed by the keyword arguments, which are named like the
+        options: Config(bv=[1, 5], nop=[2, 2], ps='letterpaper', out='hp.pdf')
+    """
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, **settings):
+        defaults = get_defaults()
+        unknown = sorted(set(settings) - set(defaults))
+        if unknown:
+            raise TypeError('Unknown setting(s): ' + ', '.join(unknown))
+        # the default seed is drawn once per process, each set gets its own
+        defaults['sns'] = random.randint(0, MAXIMUM)
+        self.__dict__.update(defaults)
+        self.__dict__.update(settings)
+
+    def __repr__(self):
+        return 'Config(' + ', '.join(f'{key}={value!r}' for key, value in \
+            sorted(vars(self).items())) + ')'
+
+
+class BuildError(Exception):
+    """ Making a money set failed (the reason has been printed) """
 
 class Serialnumber:
     """
@@ -231,12 +476,26 @@ def set_validrange(value, mini, maxi):
     return temp_value
 
 
+def parse_ranges(text):
+    """
+        '37-38,41' -> [(37, 38), (41, 41)]. ValueError if a range is reversed (38-37).
+    """
+    ranges = []
+    for part in text.split(',') if text else []:
+        first, _, last = part.partition('-')
+        first, last = int(first), int(last or first)
+        if last < first:
+            raise ValueError(f'reversed range {part}')
+        ranges.append((first, last))
+    return ranges
+
+
 def create_xwm_file(file_bills, totalpages):
     """
         This creates a required xwm file (watermark)
     """
 
-    with open(DIR_PATH/(file_bills + '.xwm'), 'w', encoding='UTF-8') as xwm_file:
+    with open(file_bills.with_suffix('.xwm'), 'w', encoding='UTF-8') as xwm_file:
         xwm_file.write(r'\relax'+'\n'\
         r'\xwmnewlabel{xwmlastpage}{{}{' + str(totalpages) + r'}{\relax}{Doc-Start}{}}'+'\n')
 
@@ -245,6 +504,7 @@ def args_validator(args, all_defargs):
     """
         Validates and rewrites the passed arguments
     """
+    # pylint: disable=too-many-branches,too-many-statements
     imin = 0
     imax = MAXIMUM
 
@@ -287,84 +547,177 @@ def args_validator(args, all_defargs):
             sn1 = set_validrange(int(all_defargs.get('sn')[1]), 1, imax)
         args.sn = (sn0, sn1)
 
-        # s/n seed
-        args.sns = set_validrange(all_defargs.get('sns'), imin, imax)
-
         # bills size
         args.width = set_validrange(all_defargs.get('width'), imin, imax)
         args.height = set_validrange(all_defargs.get('height'), imin, imax)
 
-        return
-
-    # Serial numbers stuff
-    sn0 = set_validrange(int(args.sn[0]), 1, imax)
-    if int(args.sn[1]) <= sn0:
-        sn1 = max
     else:
-        sn1 = set_validrange(int(args.sn[1]), 1, imax)
-    args.sn = (sn0, sn1)
+        # Serial numbers stuff
+        sn0 = set_validrange(int(args.sn[0]), 1, imax)
+        if int(args.sn[1]) <= sn0:
+            sn1 = max
+        else:
+            sn1 = set_validrange(int(args.sn[1]), 1, imax)
+        args.sn = (sn0, sn1)
 
-    # s/n seed
+    # s/n seed, also with -rec: the default is drawn anew in every process, the
+    # bills of -pages and of -worker tasks need the seed of the whole set
     args.sns = set_validrange(args.sns, imin, imax)
 
+    # parallel lualatex runs
+    if args.j < 1:
+        args.j = os.cpu_count() or 1
+
+    args.chunk = max(0, args.chunk)
+    args.maxpages = max(0, args.maxpages)
+
+    if args.registry and args.snlegacy:
+        print('-registry does not work with -snlegacy')
+        sys.exit(1)
+
     # check number of pages of each bill value
     args.nop = [int(set_validrange(int(i), 0, 10000)) for i in args.nop]
 
     # check bill values
     args.bv = [int(set_validrange(int(i), 1, 10000)) for i in args.bv]
 
-    # number of columns
-    args.col = set_validrange(all_defargs.get('col'), 1, 100)
-
     # bills per page: min 1, max 1000
     args.bpp = set_validrange(args.bpp, 1, 1000)
 
-    # check if page is full
-    if args.bpp % args.col != 0:
-        print('Incomplete row found. Please check "-bpp" and "-col".')
-        sys.exit(1)
+    # number of columns
+    args.col = set_validrange(args.col, 1, min(100, args.bpp))
+
+    # sheets to print again (zero-based), None = all
+    args.sheets = None
+    if args.pages or args.bills:
+        try:
+            # (ranges, numbers per sheet)
+            selections = [(parse_ranges(args.pages), 2), (parse_ranges(args.bills), args.bpp)]
+            if not any(ranges for ranges, _ in selections):
+                raise ValueError('no pages')
+        except ValueError:
+            print('-pages and -bills take numbers and ranges (first-last), like this: 37-38,41')
+            sys.exit(1)
+        # checked before the ranges are expanded, so that 1-300000000 costs nothing
+        if any(first < 1 or last > sum(args.nop) * per_sheet \
+                for ranges, per_sheet in selections for first, last in ranges):
+            print(f'-pages/-bills: there are only {sum(args.nop) * 2} pages with '\
+                f'{sum(args.nop) * args.bpp} bills')
+            sys.exit(1)
+        sheets = set()
+        for ranges, per_sheet in selections:
+            for first, last in ranges:
+                sheets.update(range((first - 1) // per_sheet, (last - 1) // per_sheet + 1))
+        if args.registry:
+            print('-pages and -bills do not work with -registry')
+            sys.exit(1)
+        args.sheets = sorted(sheets)
+
+    # every image is there and can be read
+    check_assets(args)
+
 
+def get_place_bills(bpp, col):
+    """
+        Which bill of a sheet goes where. includepdf fills the sheet column by column;
+        on the back side, the columns are mirrored, so that every back is behind its
+        front. Returns (rows, front, back): the bill (0..bpp-1) of every place of the
+        front and back side, None for the empty places of an incomplete last row.
+    """
+    rows = math.ceil(bpp / col)
+    places = range(rows * col)
+    front = [place if place < bpp else None for place in places]
+    back = [(col - 1 - place // rows) * rows + place % rows for place in places]
+    back = [bill if bill < bpp else None for bill in back]
+    return rows, front, back
 
-def make_backside_array(deq_input, irow):
+
+def plan_imposition(bpp, col, sheets):
     """
-        Makes the required array for mulitcolumn printing.
-        Derived from:
-        https://www.geeksforgeeks.org/python-slicing-reverse-array-groups-given-size/
+        Page order of the printable document, for all sheets at once.
+        Bill i of a sheet is on page 2i+1 (front) and 2i+2 (back) of its part of the
+        bills pdf. Returns (rows, front, back), front[k]/back[k] being the pages for
+        sheet k, with None for empty places.
     """
+    rows, front_bills, back_bills = get_place_bills(bpp, col)
+
+    # page numbers of the first sheet
+    front_first = [None if bill is None else 2 * bill + 1 for bill in front_bills]
+    back_first = [None if bill is None else 2 * bill + 2 for bill in back_bills]
 
-    # convert deque to list
-    lst = []
-    for deq in deq_input:
-        lst.append(deq)
-    deq_input = lst
+    # every following sheet is the same, 2 * bpp pages further
+    front = [[None if page is None else page + 2 * bpp * sheet for page in front_first] \
+        for sheet in range(sheets)]
+    back = [[None if page is None else page + 2 * bpp * sheet for page in back_first] \
+        for sheet in range(sheets)]
+    return rows, front, back
 
-    # set starting index at 0
-    start = int(0)
 
-    # run a while loop len(input)/irow times
-    # because there will be len(input)/k number
-    # of groups of size irow
-    result = []
-    while start < len(deq_input):
-        # select current group of size of k
-        # reverse it and concatenate
-        result += list(reversed(deq_input[start:start + irow]))
-        start += irow
+def get_shared_sides(args):
+    """
+        Sides that are the same on all bills of a value, so they are made only once
+        for each value: front and back with -s, the back with -sb. Not with -d (the
+        bills are numbered) and -direct (there are no pages to share).
+    """
+    if args.d or args.direct:
+        return ()
+    if args.s:
+        return ('front', 'back')
+    if args.sb:
+        return ('back',)
+    return ()
+
+
+def plan_bill_pages(args, unit):
+    """
+        The (front, back) page in the bills pdf of every bill of unit, if sides are made
+        only once (get_shared_sides). A value with -s is two pages; with -sb, the first
+        bill of a value is front and back, then come the fronts of the others.
+        None if every bill has its own two pages.
+    """
+    shared = get_shared_sides(args)
+    if not shared:
+        return None
+
+    pages = []
+    page = 0
+    for _, cntfirst, cntlast in get_bill_ranges(args, unit):
+        count = cntlast - cntfirst
+        if not count:
+            continue
+        if 'front' in shared:
+            pages += [(page + 1, page + 2)] * count
+            page += 2
+        else:
+            pages.append((page + 1, page + 2))
+            pages += [(page + 2 + bill, page + 2) for bill in range(1, count)]
+            page += count + 1
+    return pages
 
-    result = reversed(result)
-    dq_tmp = deque()
-    [dq_tmp.append(i) for i in result] # pylint: disable=W0106
-    result = dq_tmp
 
-    return result
+def compact_pages(pages):
+    """
+        Page list for includepdf: runs of consecutive pages are written
+        as ranges (4-7), empty places as {}
+    """
+    runs = []
+    for page in pages:
+        if page is not None and runs and runs[-1] is not None and page == runs[-1][1] + 1:
+            runs[-1][1] = page
+        else:
+            runs.append(None if page is None else [page, page])
+    return ', '.join('{}' if run is None else str(run[0]) if run[0] == run[1] \
+        else f'{run[0]}-{run[1]}' for run in runs)
 
 
-def create_printable_doc(args, totalpages, file_bills, file_print):
+def create_printable_doc(args, units, file_print, pdfs):
     """
-        Creates the pdf-document with all the bills for duplex printing
+        Creates the pdf-document with all the bills for duplex printing.
+        Every sheet is taken from the compiled pdf of its unit (pdfs: unit name -> file).
     """
+    # pylint: disable=too-many-locals
 
-    out = codecs.open(DIR_PATH/file_print, 'w', encoding='utf8')
+    out = open(file_print, 'w', encoding='utf8', newline='\n') # pylint: disable=consider-using-with
     out.write(r'% !TeX TS-program = lualatex'+'\n') # TeXstudio magic comment!
     out.write(r'\documentclass{article}'+'\n')
     out.write(r'\usepackage[landscape,'+ args.ps +']{geometry}'+'\n')
@@ -374,54 +727,46 @@ def create_printable_doc(args, totalpages, file_bills, file_print):
     billsize = 'width=' + str(round(args.width, 2)) + 'mm, height=' + \
         str(round(args.height, 2)) + 'mm, '
 
-    # Not every combination of rows/columns seem to work.
-    # I'm not that good at math ...
-    # It works best, if all rows and columns are completely filled.
-    icol = int(args.col)
-    ibpp = int(args.bpp)
+    if args.direct:
+        # bills are on the paper already, only put the units together
+        for unit in units:
+            out.write(r'\includepdf[pages=-, noautoscale, '\
+                r'pagecommand={\thispagestyle{empty}}]{' + pdfs[unit.name] + '}'+'\n')
+        out.write(r'\end{document}'+'\n')
+        out.close()
+        return
 
-    # number of rows in final pdf
-    irow = int(args.bpp / icol)
+    # number of rows in final pdf, page order of all sheets
+    ibpp = int(args.bpp)
+    icol = int(args.col)
+    irow, front_pages, back_pages = plan_imposition(ibpp, icol, \
+        max([unit.pages for unit in units] + [0]))
+    _, front_bills, back_bills = get_place_bills(ibpp, icol)
 
     #
     #
-    pgoffset = 0
-    for _ in range(totalpages):
-        ibppcheck = 0
-        front_page = deque()
-        back_page = deque()
-
-        for ibillnum in range(pgoffset * ibpp, (pgoffset * ibpp) + 2 * ibpp):
-            ibillnum += 1
-            if ibppcheck < ibpp:
-                if ibillnum % 2 == 0:
-                    back_page.append(ibillnum)
-                    ibppcheck += 1
-                else:
-                    # add all odd numbers
-                    front_page.append(ibillnum)
-
-        back_page = make_backside_array(back_page, irow)
-
-        # needs to add a place holder if the last row is incomplete
-        if ibpp % icol != 0:
-            irow = int((ibpp + 1) / icol)
-            back_page.insert(irow - 1, '')
-            front_page.insert(ibpp, '')
-
-        out.write(r'\includepdf[pages={'+', '.join(str(x) for x in front_page) + r'}, '\
-            r'offset=0.0mm 0.0mm, noautoscale, ' + billsize + 'nup=' + str(icol) + 'x' + \
-            str(irow) + r', pagecommand={\thispagestyle{empty}}, column=true, '\
-            r'columnstrict=true]{' + file_bills + '}'+'\n')
-
-        out.write(r'\includepdf[pages={'+', '.join(str(x) for x in back_page) + \
-            '}, offset=' + str(round(float(args.dupoff[0]), 2)) + 'mm ' + \
-            str(round(float(args.dupoff[1]), 2)) + 'mm, noautoscale, ' + billsize + \
-            r'nup=' + str(icol) + 'x' + str(irow) + \
-            r', pagecommand={\thispagestyle{empty}}, column=true, '\
-            r'columnstrict=true]{' + file_bills + '}'+'\n')
-
-        pgoffset += 2
+    for unit in units:
+        file_bills = pdfs[unit.name]
+        bill_pages = plan_bill_pages(args, unit)
+        for sheet in range(unit.pages):
+            if bill_pages is not None:
+                # sides made once are used again and again
+                front_pages[sheet] = [None if bill is None else \
+                    bill_pages[sheet * ibpp + bill][0] for bill in front_bills]
+                back_pages[sheet] = [None if bill is None else \
+                    bill_pages[sheet * ibpp + bill][1] for bill in back_bills]
+
+            out.write(r'\includepdf[pages={' + compact_pages(front_pages[sheet]) + r'}, '\
+                r'offset=0.0mm 0.0mm, noautoscale, ' + billsize + 'nup=' + str(icol) + 'x' + \
+                str(irow) + r', pagecommand={\thispagestyle{empty}}, column=true, '\
+                r'columnstrict=true]{' + file_bills + '}'+'\n')
+
+            out.write(r'\includepdf[pages={' + compact_pages(back_pages[sheet]) + \
+                '}, offset=' + str(round(float(args.dupoff[0]), 2)) + 'mm ' + \
+                str(round(float(args.dupoff[1]), 2)) + 'mm, noautoscale, ' + billsize + \
+                r'nup=' + str(icol) + 'x' + str(irow) + \
+                r', pagecommand={\thispagestyle{empty}}, column=true, '\
+                r'columnstrict=true]{' + file_bills + '}'+'\n')
     #
     #
 
@@ -429,267 +774,1843 @@ def create_printable_doc(args, totalpages, file_bills, file_print):
     out.close()
 
 
-def main(args, all_defargs):
+class Profiler:
     """
-        MAIN
+        Records wall and CPU time, peak RSS and bytes written of each stage (-profile).
+        Peak RSS is only available where the 'resource' module exists (not on Windows).
     """
-    # Validate submitted arguments
-    args_validator(args, all_defargs)
 
-    # If user wants to calibrate his/her printer:
-    if args.pc:
-        args.d = True
-        args.nop = [1]
-        args.bv = [1]
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.stages = []
+        self._local = threading.local() # stages can run in parallel threads (-j)
+
+    @staticmethod
+    def _maxrss():
+        if resource is None:
+            return None
+        # ru_maxrss is in KiB on Linux, but in bytes on macOS
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == 'darwin' else rss * 1024
+
+    @contextmanager
+    def stage(self, name, outputs=()):
+        """ time the enclosed block; outputs are the files written by it """
+        if not self.enabled:
+            yield
+            return
+
+        record = {'stage': name, 'wall': 0.0, 'cpu': 0.0, 'maxrss': None, \
+            'child_maxrss': None, 'bytes': 0}
+        self._local.current = record
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            record['wall'] = time.perf_counter() - wall
+            record['cpu'] += time.thread_time() - cpu
+            record['maxrss'] = self._maxrss()
+            record['bytes'] = sum(os.path.getsize(f) for f in outputs if os.path.isfile(f))
+            self.stages.append(record)
+            self._local.current = None
+
+    def add_child(self, rusage):
+        """ account a finished child process (rusage from os.wait4) to the current stage """
+        current = getattr(self._local, 'current', None)
+        if not self.enabled or current is None or rusage is None:
+            return
+        rss = rusage.ru_maxrss if sys.platform == 'darwin' else rusage.ru_maxrss * 1024
+        current['child_maxrss'] = max(current['child_maxrss'] or 0, rss)
+        current['cpu'] += rusage.ru_utime + rusage.ru_stime
+
+    def report(self):
+        """ print a summary table """
+        def mib(value):
+            return '-' if value is None else f'{value / 2**20:.1f}'
 
-    totalpages = sum(args.nop)
+        print('')
+        print(f'{"Stage":<24}{"Wall [s]":>10}{"CPU [s]":>10}{"RSS [MiB]":>11}'\
+            f'{"TeX RSS [MiB]":>15}{"Written [KiB]":>15}')
+        for rec in self.stages:
+            print(f'{rec["stage"]:<24}{rec["wall"]:>10.2f}{rec["cpu"]:>10.2f}'\
+                f'{mib(rec["maxrss"]):>11}{mib(rec["child_maxrss"]):>15}'\
+                f'{rec["bytes"] / 1024:>15.1f}')
+        print(f'{"Total":<24}{sum(r["wall"] for r in self.stages):>10.2f}'\
+            f'{sum(r["cpu"] for r in self.stages):>10.2f}')
+
+    def write_json(self, path, args):
+        """ write the stages and the job settings to a JSON file """
+        import json
+        with open(path, 'w', encoding='UTF-8') as json_file:
+            json.dump({'created': time.strftime('%Y-%m-%dT%H:%M:%S'), \
+                'bills': sum(args.nop) * args.bpp, 'pages': sum(args.nop), \
+                'settings': {k: v for k, v in vars(args).items() \
+                    if isinstance(v, (int, float, str, bool, list, tuple))}, \
+                'stages': self.stages}, json_file, indent=2)
+
+
+class Progress:
+    """
+        Reports how far the tasks are, at most -progressrate times per second each:
+        as progress bars, or with -events as JSON lines for other programs.
+    """
 
-    file_bills = '1-main'
-    file_print = '2-print'
-    files_ext_tex = '.tex'
+    def __init__(self, events=None, rate=4, out=None):
+        self.interval = 1 / rate if rate > 0 else None
+        self.out = out
+        self._last = {}
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self._file = None
+        if events == '-':
+            self._file = sys.stdout
+        elif events:
+            # opened for appending, so batch jobs can share the file line by line
+            # pylint: disable-next=consider-using-with
+            self._file = open(DIR_PATH/events, 'a', encoding='utf8')
+
+    def update(self, task, done, total):
+        """ done of total of task, unless task was reported just now """
+        if self.interval is None:
+            return
+        now = time.perf_counter()
+        if now - self._last.get(task, -self.interval) < self.interval:
+            return
+        self._last[task] = now
+        self._report('progress', task, done, total)
+
+    def finish(self, task, total):
+        """ task is done (always reported) """
+        self._last.pop(task, None)
+        self._report('done', task, total, total)
+
+    def _report(self, event, task, done, total):
+        import json
+        with self._lock:
+            if self._file is None:
+                if total:
+                    print_progress_bar(done, total, prefix=task + ':')
+                return
+            self._file.write(json.dumps({'time': round(time.perf_counter() - self._start, 3), \
+                'out': self.out, 'event': event, 'task': task, 'done': done, \
+                'total': total}) + '\n')
+            self._file.flush()
+
+    def close(self):
+        """ closes the -events file """
+        if self._file not in (None, sys.stdout):
+            self._file.close()
+
+
+def run_lualatex(args, texfile, profiler, pages=0, fmt=None):
+    """
+        Compiles texfile (with the format fmt) and returns lualatex's (-engine) exit
+        code. The output goes next to texfile, images are looked up from DIR_PATH. The
+        pages lualatex writes ([1] [2] ... of pages) are reported to args.progress.
+    """
+    # pylint: disable=too-many-locals
+    import re
+    import shlex
+    import subprocess
+    cmd = shlex.split(args.engine) + (['-fmt=' + str(fmt.with_suffix(''))] if fmt else []) + \
+        ['-output-directory', str(texfile.parent), '-interaction=nonstopmode', str(texfile)]
+
+    task = 'lualatex ' + texfile.stem
+    page = 0
+    tail = deque(maxlen=20) # shown if it fails, the rest is in the log
+    # pylint: disable-next=consider-using-with
+    proc = subprocess.Popen(cmd, cwd=DIR_PATH, stdout=subprocess.PIPE, \
+        stderr=subprocess.STDOUT)
+    for line in io.TextIOWrapper(proc.stdout, encoding='utf8', errors='replace'):
+        tail.append(line)
+        for number in re.findall(r'\[(\d+)(?=[\]{<\s]|$)', line):
+            page = max(page, int(number))
+        if page:
+            args.progress.update(task, page, max(page, pages))
+
+    if hasattr(os, 'wait4'):
+        # wait4 also returns the resource usage of that very child
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        profiler.add_child(rusage)
+    else:
+        proc.communicate()
 
-    create_xwm_file(file_bills, totalpages) # create a required (watermark) file
-    create_tex_main(args, file_bills + files_ext_tex)
-    create_printable_doc(args, totalpages, file_bills, (file_print + files_ext_tex))
+    if proc.returncode != 0:
+        print(''.join(tail))
+    else:
+        args.progress.finish(task, max(page, pages))
+    return proc.returncode
 
-    cmd = ['lualatex', '-output-directory', str(DIR_PATH), '-interaction=nonstopmode', \
-        str(DIR_PATH/(file_bills + files_ext_tex))]
 
-    # make two runs, because ....?!?
-    for _ in range(2):
-        proc = subprocess.Popen(cmd)
-        proc.communicate()
-        if proc.returncode != 0:
-            print('Something went wrong with ' + (file_bills + files_ext_tex))
-            sys.exit(1)
+_ENGINE_VERSIONS = {}
 
-    retcode = proc.returncode
-    if retcode == 0:
-        cmd = ['lualatex', '-output-directory', str(DIR_PATH), '-interaction=nonstopmode', \
-        str(DIR_PATH/(file_print + files_ext_tex))]
-        proc = subprocess.Popen(cmd)
-        proc.communicate()
+def get_engine_version(args):
+    """
+        First line of "-engine --version": a format only works with the engine that made it
+    """
+    import shlex
+    import subprocess
+    if args.engine not in _ENGINE_VERSIONS:
+        try:
+            proc = subprocess.run(shlex.split(args.engine) + ['--version'], cwd=DIR_PATH, \
+                capture_output=True, text=True, check=False)
+            _ENGINE_VERSIONS[args.engine] = (proc.stdout.splitlines() or [''])[0]
+        except OSError:
+            _ENGINE_VERSIONS[args.engine] = ''
+    return _ENGINE_VERSIONS[args.engine]
+
+
+def dump_format(args, preamble, fmt):
+    """
+        Makes the format fmt of preamble (lualatex -ini ... \\dump) and checks that
+        a document compiles with it. The preamble is kept next to it (.tex), to put
+        it back if a file doesn't compile with the format. True if that worked.
+    """
+    import shlex
+    import tempfile
+    import subprocess
+    cmd = shlex.split(args.engine)
+    tmpdir = Path(tempfile.mkdtemp(dir=fmt.parent)) # same folder, for os.replace
+    try:
+        (tmpdir/'preamble.tex').write_text(preamble + '\\dump\n', encoding='utf8')
+        (tmpdir/'check.tex').write_text('\\begin{document}\nMoney\n\\end{document}\n', \
+            encoding='utf8')
+        options = ['-output-directory', str(tmpdir), '-interaction=nonstopmode']
+        for run in (cmd + ['-ini', '-jobname=' + fmt.stem] + options + \
+                ['&' + Path(cmd[0]).stem, str(tmpdir/'preamble.tex')], \
+                cmd + ['-fmt=' + str(tmpdir/fmt.stem)] + options + [str(tmpdir/'check.tex')]):
+            if subprocess.run(run, cwd=DIR_PATH, stdout=subprocess.DEVNULL, \
+                    stderr=subprocess.STDOUT, check=False).returncode != 0:
+                return False
+        if not (tmpdir/fmt.name).is_file():
+            return False
+        (tmpdir/'preamble.tex').write_text(preamble, encoding='utf8')
+        os.replace(tmpdir/'preamble.tex', fmt.with_suffix('.tex'))
+        os.replace(tmpdir/fmt.name, fmt)
+        return True
+    finally:
+        rmtree(tmpdir, ignore_errors=True)
+
+
+_FORMAT_LOCKS = {}
+_FORMAT_LOCKS_LOCK = threading.Lock()
+
+def use_format(args, texfile, profiler):
+    """
+        With -format: the format to compile texfile with, made from its preamble
+        (everything before \\begin{document}) once and kept in <cache>/formats.
+        The preamble is removed from texfile then. None if there is no format, or
+        if a file didn't compile with it before (see run_lualatex_format).
+    """
+    import hashlib
+    if not args.format:
+        return None
+    preamble, begin, body = texfile.read_text(encoding='utf8').partition(r'\begin{document}')
+    if not begin:
+        return None
+
+    formats = get_cachedir(args, always=True)/'formats'
+    formats.mkdir(exist_ok=True)
+    key = hashlib.sha256((get_engine_version(args) + '\n' + preamble).encode('utf8'))
+    fmt = formats/(key.hexdigest()[:32] + '.fmt')
+    with _FORMAT_LOCKS_LOCK:
+        lock = _FORMAT_LOCKS.setdefault(fmt.name, threading.Lock())
+    with lock: # the units of -j share a preamble, it's dumped once
+        if not (fmt.is_file() and fmt.with_suffix('.tex').is_file()) and \
+                not fmt.with_suffix('.failed').is_file():
+            with profiler.stage(f'format {fmt.stem[:8]}', [fmt]):
+                if not dump_format(args, preamble, fmt):
+                    print(f'**** Could not make a format of the preamble of {texfile.name}, '\
+                        'compiling without one')
+                    fmt.with_suffix('.failed').touch()
+    if not fmt.is_file() or fmt.with_suffix('.failed').is_file():
+        return None
+
+    texfile.write_text(begin + body, encoding='utf8')
+    return fmt
+
+
+def run_lualatex_format(args, texfile, profiler, pages, fmt):
+    """
+        run_lualatex with the format fmt (of use_format). If that fails, but not for
+        lack of TeX memory, the format is marked as failed, its preamble is put back
+        into texfile and that is compiled without a format (Lua code of the packages
+        isn't kept in a format, this can fail even if the check in dump_format
+        didn't). Returns (exit code, the format still to use).
+    """
+    retcode = run_lualatex(args, texfile, profiler, pages, fmt)
+    if retcode == 0 or fmt is None or is_out_of_memory(texfile.with_suffix('')):
+        return retcode, fmt
+    print(f'**** {texfile.name} did not compile with the format of its preamble, '\
+        'compiling it without one')
+    fmt.with_suffix('.failed').touch()
+    texfile.write_text(fmt.with_suffix('.tex').read_text(encoding='utf8') + \
+        texfile.read_text(encoding='utf8'), encoding='utf8')
+    return run_lualatex(args, texfile, profiler, pages), None
 
-        retcode = proc.returncode
-        if retcode == 0:
-            copyfile(str(DIR_PATH/(file_print + '.pdf')), str(DIR_PATH/'yourMoney.pdf'))
 
-        else:
-            print('Something went wrong with ' + (file_print + files_ext_tex))
-            sys.exit(1)
+_FILE_DIGESTS = {}
 
-        remove_files = ["aux", "pdf", "log", "tex", "xwm"]
-        for rmfile in remove_files:
-            try:
-                os.remove(DIR_PATH/(file_bills + '.' + rmfile))
-                os.remove(DIR_PATH/(file_print + '.' + rmfile))
-            except OSError as err:
-                print(err.strerror)
+def file_digest(path):
+    """
+        sha256 of a file. Remembered for as long as size and mtime don't change.
+    """
+    import hashlib
+    stat = os.stat(path)
+    memo = (str(path), stat.st_size, stat.st_mtime_ns)
+    if memo not in _FILE_DIGESTS:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as img_file:
+            for block in iter(lambda: img_file.read(1 << 20), b''):
+                digest.update(block)
+        _FILE_DIGESTS[memo] = digest.hexdigest()
+    return _FILE_DIGESTS[memo]
+
+
+def find_image_file(name):
+    """
+        Returns the file includegraphics will use for name, or None if there is none
+    """
+    for ext in ('',) + IMAGE_EXTENSIONS:
+        path = DIR_PATH/(name + ext)
+        if path.is_file():
+            return path
+    return None
 
-        print('')
-        print('**** All done!')
-        print(f'**** Total of {str(sum(args.nop) * args.bpp)} bills on {sum(args.nop)} pages.')
-        print('**** Your file (yourMoney.pdf) is ready to be duplex-printed along the short edge.')
 
-    else:
-        print('Something went wrong with ' + (file_bills + files_ext_tex))
-        sys.exit(1)
+def get_unit_key(args, unit, texfile):
+    """
+        Cache key of a unit: its tex file (serial numbers, bill size, fonts, offsets, ...)
+        and the content of every image it uses.
+    """
+    import hashlib
+    key = hashlib.sha256(texfile.read_bytes())
+    indices = range(len(args.nop)) if unit.index is None else [unit.index]
+    for i in indices:
+        for image in get_bill_images(args, str(args.bv[i])):
+            imgfile = find_image_file(image)
+            key.update(image.encode('utf8'))
+            key.update(file_digest(imgfile).encode('ascii') if imgfile else b'-')
+    return key.hexdigest()[:32]
+
+
+def get_cachedir(args, always=False):
+    """
+        Returns the (existing) cache folder, or None if -cache isn't set (and not always)
+    """
+    if not args.cache and not always:
+        return None
+    cachedir = Path(args.cachedir)
+    if not cachedir.is_absolute():
+        cachedir = DIR_PATH/cachedir
+    cachedir.mkdir(parents=True, exist_ok=True)
+    return cachedir
 
 
-# Print iterations progress
-def print_progress_bar(iteration, total, prefix=''):
+def copy_atomic(src, dst):
     """
-    Call in a loop to create terminal progress bar
-    @params:
-        iteration   - Required  : current iteration (Int)
-        total       - Required  : total iterations (Int)
-        prefix      - Optional  : prefix string (Str)
-        suffix      - Optional  : suffix string (Str)
-        decimals    - Optional  : positive number of decimals in percent complete (Int)
-        length      - Optional  : character length of bar (Int)
-        fill        - Optional  : bar fill character (Str)
+        Copies src to dst (the cache, the output, the spool folder).
+        Readers never see a half written file.
     """
-    suffix = ''
-    decimals = 1
-    length = 50 # int((os.get_terminal_size(1).columns - 20) / 2)
-    fill = '█'
-
-    percent = ("{0:." + str(decimals) + "f}").format(100 * (iteration / float(total)))
-    filledlength = int(length * iteration // total)
-    pbar = fill * filledlength + '-' * (length - filledlength)
-    # print('\r%s |%s| %s%% %s' % (prefix, pbar, percent, suffix), end='\r')
-    print(f'\r{prefix} |{pbar}| {percent}% {suffix}', end='\r')
-    # Print New Line on Complete
-    if iteration == total:
-        print()
+    tmpfile = dst.with_name(dst.name + f'.{os.getpid()}-{threading.get_ident()}.tmp')
+    copyfile(str(src), str(tmpfile))
+    os.replace(tmpfile, dst)
 
 
-def get_random_list(args):
+def move_atomic(src, dst):
     """
-        pylint ... I don't like you anymore
+        Moves src to dst (the output, the spool folder). Across file systems, e.g. from
+        a -workdir in /dev/shm, src is copied with copy_atomic instead.
     """
+    try:
+        os.replace(src, dst)
+    except OSError as err:
+        if err.errno != errno.EXDEV:
+            raise
+        copy_atomic(src, dst)
+        os.remove(src)
 
-    itotalallbills = sum(args.nop) * args.bpp
-    # print(f'\n### Total Bills: {str(itotalallbills)}\n')
 
-    random.seed(args.sns)
-    lstserial = []
-    newmaxsn = args.sn[1]
-    if itotalallbills > (args.sn[1] - args.sn[0]):
-        newmaxsn = args.sn[1] + args.sn[0] + itotalallbills
+def tex_path(path):
+    """
+        Path as written into a tex file: relative to DIR_PATH if in there (cache,
+        images), else absolute (workdir), with slashes
+    """
+    try:
+        return Path(path).relative_to(DIR_PATH).as_posix()
+    except ValueError:
+        return Path(path).as_posix()
 
-    print()
 
-    cnt = 0
-    while len(lstserial) < itotalallbills:
-        rnd = random.randint(args.sn[0], newmaxsn)
-        if rnd not in lstserial:
-            lstserial.append(rnd)
-            cnt += 1
-            if itotalallbills > 500:
-                print_progress_bar(cnt, itotalallbills, prefix='Creating Serial Numbers: ')
+def resample_image(source, target, size, quality):
+    """
+        Saves source, scaled down to size (if larger), as target.jpg (JPEG of quality)
+        or, if quality is 0 or the image has transparency, as target.png. Palette
+        images stay palette images. If that isn't smaller than source, source is
+        kept instead (copied to target.png or target.jpg). Returns the file written.
+    """
+    from PIL import Image
+    with Image.open(source) as img:
+        kind = img.format
+        palette = img.mode in ('P', 'PA')
+        alpha = img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info
+        if img.mode not in ('RGB', 'RGBA', 'L'):
+            img = img.convert('RGBA' if alpha else 'RGB')
+        if img.width > size[0] or img.height > size[1]:
+            img = img.resize((min(img.width, size[0]), min(img.height, size[1])), \
+                Image.Resampling.LANCZOS)
+        target = target.with_suffix('.jpg' if quality and not alpha else '.png')
+        tmpfile = target.with_name(target.name + f'.{os.getpid()}.tmp')
+        if target.suffix == '.jpg':
+            img.save(tmpfile, 'JPEG', quality=quality, optimize=True)
+        else:
+            if palette:
+                img = img.quantize(256, method=Image.Quantize.FASTOCTREE if alpha \
+                    else Image.Quantize.MEDIANCUT)
+            img.save(tmpfile, 'PNG', optimize=True)
 
+    if tmpfile.stat().st_size >= source.stat().st_size and kind in ('PNG', 'JPEG'):
+        os.remove(tmpfile)
+        target = target.with_suffix('.png' if kind == 'PNG' else '.jpg')
+        tmpfile = target.with_name(target.name + f'.{os.getpid()}.tmp')
+        copyfile(source, tmpfile)
+    os.replace(tmpfile, target)
+    return target
 
-    return lstserial
+
+def prepare_images(args):
+    """
+        -dpi: scales the bill images down to the resolution needed for the bill size.
+        Returns image name -> name of the scaled image. The scaled images are
+        kept, named by the content of the original and the target size.
+    """
+    # pylint: disable=too-many-locals
+    if not args.dpi:
+        return {}
+    try:
+        import PIL # pylint: disable=unused-import
+    except ImportError:
+        print('-dpi needs Pillow (pip install pillow), the images are used as they are')
+        return {}
+    import hashlib
+    from concurrent.futures import ProcessPoolExecutor
+
+    size = (round(float(args.width) / 25.4 * args.dpi), round(float(args.height) / 25.4 * args.dpi))
+    quality = set_validrange(args.imgquality, 0, 95)
+    imagedir = get_cachedir(args, always=True)/'images'
+    imagedir.mkdir(exist_ok=True)
+
+    images = {}
+    todo = {}
+    for lbv in args.bv:
+        for image in get_source_images(args, str(lbv)):
+            imgfile = find_image_file(image)
+            if image in images or imgfile is None or \
+                    imgfile.suffix.lower() not in ('.png', '.jpg', '.jpeg'):
+                continue
+            key = hashlib.sha256(f'{file_digest(imgfile)} {size} {quality}'.encode('ascii'))
+            target = imagedir/key.hexdigest()[:32]
+            for ext in ('.jpg', '.png'):
+                if target.with_suffix(ext).is_file():
+                    images[image] = target.with_suffix(ext)
+            if image not in images:
+                todo.setdefault(target, imgfile)
+                images[image] = target
+
+    if todo:
+        print(f'**** Scaling {len(todo)} image(s) to {size[0]}x{size[1]} pixels')
+        with ProcessPoolExecutor(max_workers=min(args.j, len(todo))) as pool:
+            futures = {target: pool.submit(resample_image, source, target, size, quality) \
+                for target, source in todo.items()}
+            written = {target: future.result() for target, future in futures.items()}
+        images = {image: written.get(target, target) for image, target in images.items()}
+
+    return {image: tex_path(target) for image, target in images.items()}
+
+
+def plan_units(args):
+    """
+        Splits the bills into units, which are compiled on their own: one for all bills
+        (always with -backend pdf), or, with -cache or -j, one per bill value. With -j,
+        bill values with many pages are split further, so that no unit has more than 1/j
+        of all pages. LaTeX units are kept within -maxpages.
+    """
+    # pylint: disable=too-many-locals,too-many-branches
+    totalpages = sum(args.nop)
+    if args.sheets is not None:
+        # one unit per run of consecutive sheets
+        units = []
+        for sheet in args.sheets:
+            if units and units[-1].first + units[-1].pages == sheet:
+                units[-1] = units[-1]._replace(pages=units[-1].pages + 1)
+            else:
+                units.append(BillUnit(f'1-main-{len(units) + 1}', None, sheet, 1))
+    elif args.backend == 'pdf' or (not args.cache and args.j <= 1):
+        units = [BillUnit('1-main', None, 0, totalpages)]
+    else:
+        maxpages = max(1, math.ceil(totalpages / args.j))
+        units = []
+        first = 0
+        for i, nop in enumerate(args.nop):
+            # split in equally sized parts
+            parts = math.ceil(nop / maxpages)
+            for part in range(parts):
+                pfirst = first + (nop * part) // parts
+                plast = first + (nop * (part + 1)) // parts
+                units.append(BillUnit(f'1-main-{len(units) + 1}', i, pfirst, plast - pfirst))
+            first += nop
+
+    if args.backend == 'latex' and args.maxpages and \
+            any(unit.pages * 2 * args.bpp > args.maxpages for unit in units):
+        # keep every lualatex run within TeX's memory
+        maxsheets = max(1, args.maxpages // (2 * args.bpp))
+        parts = []
+        for unit in units:
+            count = math.ceil(unit.pages / maxsheets)
+            for part in range(count):
+                pfirst = unit.first + (unit.pages * part) // count
+                plast = unit.first + (unit.pages * (part + 1)) // count
+                parts.append(BillUnit(f'1-main-{len(parts) + 1}', unit.index, pfirst, \
+                    plast - pfirst))
+        units = parts
+
+    if not args.chunk:
+        return units
+
+    # with -chunk, no unit goes beyond the end of a part
+    parts = []
+    for unit in units:
+        first = unit.first
+        while first < unit.first + unit.pages:
+            last = min(unit.first + unit.pages, (first // args.chunk + 1) * args.chunk)
+            parts.append(BillUnit(f'1-main-{len(parts) + 1}', unit.index, first, last - first))
+            first = last
+    return parts
+
+
+def plan_chunks(args, units):
+    """
+        The units of each part of the output (-chunk), or of the whole output
+    """
+    if not args.chunk:
+        return [units]
+    chunks = {}
+    for unit in units:
+        chunks.setdefault(unit.first // args.chunk, []).append(unit)
+    return [chunks[number] for number in sorted(chunks)]
 
 
-def create_tex_main(args, file_bills):
+def get_rerun_state(stem):
     """
-        Creates the bills with the serial numbers. One bill per page.
+        Returns the picture positions (pgf marks) stored in stem.aux
     """
+    try:
+        with open(stem.with_suffix('.aux'), 'rb') as aux_file:
+            return [line for line in aux_file if line.startswith(b'\\pgfsyspdfmark')]
+    except OSError:
+        return []
 
-    out = codecs.open(DIR_PATH/file_bills, 'w', encoding='utf8')
-    out.write(r'\documentclass{article}'+'\n')
-    out.write(f'\\usepackage[paperheight={args.height}mm, paperwidth={args.width}mm, margin=0pt]'\
-              + '{geometry}'+'\n')
 
-    out.write(r'\usepackage{tikz}'+'\n')
-    out.write(r'\usetikzlibrary{positioning}'+'\n')
+def needs_rerun(stem, marks):
+    """
+        True if the last run of stem.tex asked for another run or
+        changed the picture positions (marks from before that run)
+    """
+    try:
+        with open(stem.with_suffix('.log'), 'rb') as log_file:
+            log = log_file.read()
+    except OSError:
+        log = b''
+    if any(marker in log for marker in RERUN_MARKERS):
+        return True
+    return get_rerun_state(stem) != marks
 
-    get_serialnumber_setting(args, out)
 
-    out.write(r'\pagestyle{empty}'+'\n')
-    out.write(r'\begin{document}'+'\n')
+def build_unit(args, unit, lstserial, profiler, cachedir):
+    """
+        Writes and compiles the bills of one unit. Returns [(unit, pdf)]: the pdf to take
+        the unit's sheets from, as written into 2-print.tex (relative to DIR_PATH). If TeX
+        runs out of memory, the unit is split in two, and both parts are returned.
+    """
+    # pylint: disable=too-many-locals
+    stem = args.workdir/unit.name
+    if args.backend == 'pdf':
+        create_pdf = create_pdf_sheets if args.direct else create_pdf_main
+        with profiler.stage(f'{create_pdf.__name__} {unit.name}', [stem.with_suffix('.pdf')]):
+            create_pdf(args, stem.with_suffix('.pdf'), lstserial, unit)
+        return [(unit, tex_path(stem.with_suffix('.pdf')))]
+
+    texfile = stem.with_suffix('.tex')
+    create_tex = create_tex_sheets if args.direct else create_tex_main
+    with profiler.stage(f'{create_tex.__name__} {unit.name}', \
+            [texfile, stem.with_suffix('.xwm')]):
+        create_xwm_file(stem, unit.pages) # create a required (watermark) file
+        create_tex(args, texfile, lstserial, unit)
+
+    cached = None
+    if cachedir is not None:
+        cached = cachedir/(get_unit_key(args, unit, texfile) + '.pdf')
+        if cached.is_file():
+            print(f'**** {unit.name}: up to date, using {cached.name}')
+            return [(unit, tex_path(cached))]
+
+    fmt = use_format(args, texfile, profiler)
+    bill_pages = plan_bill_pages(args, unit)
+    pages = max(bill_pages[-1]) if bill_pages else \
+        unit.pages * 2 * (1 if args.direct else args.bpp)
+
+    # tikz overlays (remember picture) need a second run, to get
+    # the page coordinates from the .aux file
+    for run in range(MAX_LUALATEX_RUNS):
+        marks = get_rerun_state(stem)
+        with profiler.stage(f'lualatex {unit.name} #{run + 1}', \
+                [stem.with_suffix(ext) for ext in ('.pdf', '.aux', '.log')]):
+            retcode, fmt = run_lualatex_format(args, texfile, profiler, pages, fmt)
+        if retcode != 0 and unit.pages > 1 and is_out_of_memory(stem):
+            half = unit.pages // 2
+            print(f'**** {unit.name}: TeX capacity exceeded with {unit.pages} sheets, '\
+                'compiling it in two parts')
+            remove_files(stem, ["aux", "pdf", "log", "tex", "xwm"])
+            return build_unit(args, unit._replace(name=unit.name + 'a', pages=half), \
+                    lstserial, profiler, cachedir) + \
+                build_unit(args, unit._replace(name=unit.name + 'b', first=unit.first + half, \
+                    pages=unit.pages - half), lstserial, profiler, cachedir)
+        if retcode != 0:
+            print('Something went wrong with ' + texfile.name)
+            sys.exit(1)
+        if not needs_rerun(stem, marks):
+            break
 
-    lbillvalues = args.bv
+    if cached is None:
+        return [(unit, tex_path(stem.with_suffix('.pdf')))]
 
-    lstserial = get_random_list(args)
+    copy_atomic(stem.with_suffix('.pdf'), cached)
+    return [(unit, tex_path(cached))]
 
-    print('\n')
 
-    cnt = 0
-    snum = ''
-    padlen = len(str(args.sn[1]))
+def is_out_of_memory(stem):
+    """
+        True if the last run of stem.tex ran out of TeX memory
+    """
+    try:
+        with open(stem.with_suffix('.log'), 'rb') as log_file:
+            log = log_file.read()
+    except OSError:
+        return False
+    return any(marker in log for marker in CAPACITY_MARKERS)
 
-    for i, nop in enumerate(args.nop, 0):
 
-        lbv = str(lbillvalues[i])
-        out.write(f"% % % {lbv}\n")
+def get_unit_pdf(pdf):
+    """
+        File of a pdf returned by build_unit
+    """
+    return DIR_PATH/pdf
 
-        folder = args.folder
 
-        itotalbills = args.nop[i] * args.bpp # total bills of current value
-        itotalbills = nop * args.bpp # total bills of current value
-        itb = range(0, itotalbills)
-        scnt = 0
+def build_printable_doc(args, units, pdfs, profiler, cachedir, file_print, output):
+    """
+        Puts the bills of the units on paper (2-print.tex) and
+        compiles that into output. With -direct and -backend pdf, the sheets of
+        the units are only joined (without LaTeX).
+    """
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    import hashlib
+    stem = args.workdir/file_print
+    if args.direct and args.backend == 'pdf':
+        with profiler.stage(f'join {file_print}', [stem.with_suffix('.pdf')]):
+            pdf = PdfWriter(stem.with_suffix('.pdf'))
+            for unit in units:
+                pdf.add_pages_of(get_unit_pdf(pdfs[unit.name]))
+            pdf.close()
+        move_atomic(stem.with_suffix('.pdf'), output)
+        return
 
-        while scnt < len(itb):
+    texfile = stem.with_suffix('.tex')
+    with profiler.stage('create_printable_doc', [texfile]):
+        create_printable_doc(args, units, texfile, pdfs)
 
-            if args.snh:
-                snum = f'{lstserial[cnt]:02X}'
-            else:
-                snum = str(lstserial[cnt]).zfill(padlen)
+    cached = None
+    if cachedir is not None:
+        cached = cachedir/(hashlib.sha256(texfile.read_bytes()).hexdigest()[:32] + '-print.pdf')
 
-            if args.d:
-                out.write(r'\mypics{example-image-a}{example-image-b}{' + \
-                    lbv + '}{' + (snum) + r'}'+'\n')
-            else:
-                if not args.s:
-                    if args.frontback:
-                        out.write(r' \mypics{'+ folder +'/' + args.front + '-' + lbv +\
-                            r'}{'+ folder +'/' + args.back + '-' + lbv +\
-                            r'}{}{' + snum + r'}'+'\n')
-                    else:
-                        out.write(r' \mypics{'+ folder +'/money-' + lbv + r'}'\
-                            r'{'+ folder +'/money-' + lbv + r'}{}{' + snum + r'}'+'\n')
-                else:
-                    if args.frontback:
-                        out.write(r' \mypics{'+ folder +'/' + args.front + '-' + lbv +\
-                            r'}{'+ folder +'/' + args.back + '-' + lbv + r'}{}{}'+'\n')
-                    else:
-                        out.write(r' \mypics{'+ folder +'/money-' + lbv + r'}'\
-                            r'{'+ folder +'/money-' + lbv + r'}{}{}'+'\n')
-            scnt += 1
-            cnt += 1
+    if cached is not None and cached.is_file():
+        print(f'**** {file_print}: up to date, using {cached.name}')
+        copy_atomic(cached, output)
+        return
 
-        out.write('\n\n')
+    fmt = use_format(args, texfile, profiler)
+    with profiler.stage(f'lualatex {file_print}', \
+            [stem.with_suffix(ext) for ext in ('.pdf', '.aux', '.log')]):
+        retcode = run_lualatex_format(args, texfile, profiler, \
+            sum(unit.pages for unit in units) * 2, fmt)[0]
 
-    out.write(r'\end{document}'+'\n')
-    out.close()
+    if retcode != 0:
+        print('Something went wrong with ' + texfile.name)
+        sys.exit(1)
 
+    if cached is not None:
+        copy_atomic(stem.with_suffix('.pdf'), cached)
+    move_atomic(stem.with_suffix('.pdf'), output)
 
-def print_serialnumbers(args, out, xyf, strdebug):
+
+def get_output_file(args, chunk=None):
     """
-        do this, if the user wants serial numbers on front and back
+        The pdf to write (-out), relative to DIR_PATH unless absolute, or in -spool.
+        With -chunk, the pdf of part chunk (1, 2, ...): yourMoney-001.pdf etc.
     """
+    output = DIR_PATH/args.out
+    if args.spool:
+        output = DIR_PATH/args.spool/output.name
+    if chunk is not None:
+        output = output.with_name(f'{output.stem}-{chunk:03d}{output.suffix}')
+    return output
 
-    debugtext = ''
-    debugnode = ''
-    if args.d:
-        debugtext = r', text=black, font=\bfseries'
-        debugnode = '\t'+r'\node[opacity=.35] at (thispage.center) '
-    else:
-        debugnode = '\t'+r'\node at (thispage.center) '
 
-    out.write(r'\newcommand{\mypics}[4]{'+'\n'\
-        r'  \begin{tikzpicture}[remember picture,overlay]'+'\n'\
-        '\t'+r'\node (thispage) [shape=rectangle'\
-        r', minimum height=\paperheight, minimum width=\paperwidth, anchor=center] '\
-        r'at (current page.center) {};'+'\n')
+def remove_files(stem, extensions):
+    """
+        Removes the intermediate files stem.ext
+    """
+    for ext in extensions:
+        try:
+            os.remove(stem.with_suffix('.' + ext))
+        except FileNotFoundError:
+            pass
+        except OSError as err:
+            print(err.strerror)
 
-    out.write(debugnode)
-    out.write(r'{\includegraphics[width=\paperwidth, height=\paperheight]{#1}};'+'\n'\
-        '\t'+r'\node[xshift='+\
-        str(xyf.shiftx) + r'mm, yshift=' + str(xyf.shifty) + r'mm' + debugtext +\
-        r'] at (thispage.center) '\
-        r'{\thisfontsfamily' + strdebug + r'#4};'+'\n'\
-        r'  \end{tikzpicture}'+'\n'\
-        r'  \newpage'+'\n'\
-        r'  \begin{tikzpicture}[remember picture, overlay]'+'\n'\
-        '\t'+r'\node (thispage) [shape=rectangle, minimum height=\paperheight, '\
-        r'minimum width=\paperwidth, anchor=center] at (current page.center) {};'+'\n')
 
-    out.write(debugnode)
-    out.write(r'{\includegraphics[width=\paperwidth, height=\paperheight]{#2}};'+'\n'\
-        '\t'+r'\node[xshift=' + str(xyf.shiftbx) + r'mm, yshift=' + str(xyf.shiftby) + r'mm' +\
-        debugtext + r'] at '\
-        r'(thispage.center) {\thisfontsfamily' + strdebug + r'#4};'+'\n'\
-        r'  \end{tikzpicture}'+'\n'+r'  \newpage'+'\n}'+'\n')
+def get_workdir_base(args):
+    """
+        The (existing) -workdir folder, or None for the temp folder of the system
+    """
+    if not args.workdir:
+        return None
+    base = DIR_PATH/args.workdir
+    base.mkdir(parents=True, exist_ok=True)
+    return base
 
 
-def print_no_serial_on_backside(out, xyf, strdebug):
+def main(args, all_defargs, workdir=None):
     """
-        do this, if the user doesn't want serial numbers on the back of the bills
+        MAIN. The intermediate files are written to workdir, or to a new folder in
+        -workdir, which is removed at the end. Returns the pdf(s) written.
     """
-    # if serial number on front and back
-    out.write(r'\newcommand{\mypics}[4]{'+'\n'\
-        r'  \begin{tikzpicture}[remember picture,overlay]'+'\n'\
-        '\t'+r'\node (thispage) [shape=rectangle'\
-        r', minimum height=\paperheight, minimum width=\paperwidth, anchor=center] '\
-        r'at (current page.center) {};'+'\n'\
-        '\t'+r'\node at (thispage.center) '\
-        r'{\includegraphics[width=\paperwidth, height=\paperheight]{#1}};'+'\n'\
-        '\t'+r'\node[xshift='+\
-        str(xyf.shiftx) + r'mm, yshift=' + str(xyf.shifty) + r'mm] at (thispage.center) '\
-        r'{\thisfontsfamily' + strdebug + r'#4};'+'\n'\
-        r'  \end{tikzpicture}'+'\n'\
-        r'  \newpage'+'\n'\
-        r'  \begin{tikzpicture}[remember picture,overlay]'+'\n'\
-        '\t'+r'\node (thispage) [shape=rectangle, minimum height=\paperheight, '\
-        r'minimum width=\paperwidth, anchor=center] at (current page.center) {};'+'\n'\
-        '\t'+r'\node at '\
-        r'(thispage.center) {\includegraphics[width=\paperwidth, height=\paperheight]{#2}};'+'\n'\
-        r'  \end{tikzpicture}'+'\n'+r'  \newpage'+'\n}'+'\n')
+    import tempfile
+
+    # Validate submitted arguments
+    args_validator(args, all_defargs)
+
+    # If user wants to calibrate his/her printer:
+    if args.pc:
+        args.d = True
+        args.nop = [1]
+        args.bv = [1]
+
+    scratch = workdir is None
+    if scratch:
+        workdir = tempfile.mkdtemp(prefix='make_money-', dir=get_workdir_base(args))
+    args.workdir = Path(os.path.abspath(workdir))
+    args.workdir.mkdir(parents=True, exist_ok=True)
+
+    args.progress = Progress(args.events, args.progressrate, args.out)
+    try:
+        outputs = make_money(args)
+    except SystemExit:
+        if scratch:
+            print(f'**** The files of the failed run are kept in {args.workdir}')
+        raise
+    finally:
+        args.progress.close()
+    if scratch:
+        rmtree(args.workdir, ignore_errors=True)
+    return outputs
+
+
+def make_money(args):
+    """
+        Makes the money set of (validated) args in args.workdir.
+        Returns the pdf(s) written.
+    """
+    profiler = Profiler(args.profile or bool(args.profilejson))
+    cachedir = get_cachedir(args)
+
+    if args.distribute:
+        # the workers made the sheets, they only have to be put together
+        outputs = [join_parts(args, profiler)]
+    else:
+        with profiler.stage('prepare_images'):
+            args.images = prepare_images(args)
+
+        with open_registry(args) as registry:
+            with profiler.stage('get_random_list'):
+                lstserial = get_random_list(args, registry)
+
+            outputs = write_outputs(args, lstserial, profiler, cachedir)
+
+            # only now, a failed run doesn't use up any serial numbers
+            if registry is not None:
+                registry.add(lstserial)
+                print(f'**** {len(lstserial)} serial numbers added to {args.registry}')
+
+    print('')
+    print('**** All done!')
+    if args.sheets is not None:
+        print(f'**** Reprint of {len(args.sheets) * args.bpp} bills on {len(args.sheets)} '\
+            'pages.')
+    else:
+        print(f'**** Total of {str(sum(args.nop) * args.bpp)} bills on {sum(args.nop)} pages.')
+    if len(outputs) == 1:
+        print(f'**** Your file ({outputs[0].name}) is ready to be duplex-printed along the '\
+            'short edge.')
+    else:
+        print(f'**** Your files ({outputs[0].name} to {outputs[-1].name}) are ready to be '\
+            'duplex-printed along the short edge.')
+
+    if profiler.enabled:
+        profiler.report()
+        if args.profilejson:
+            profiler.write_json(DIR_PATH/args.profilejson, args)
+            print(f'**** Profile written to {DIR_PATH/args.profilejson}')
+
+    return outputs
+
+
+def write_outputs(args, lstserial, profiler, cachedir):
+    """
+        Compiles the bills and puts them on paper. Returns the pdf(s) written.
+    """
+    # pylint: disable=too-many-locals
+    from concurrent.futures import ThreadPoolExecutor
+    if args.spool:
+        (DIR_PATH/args.spool).mkdir(parents=True, exist_ok=True)
+
+    units = plan_units(args)
+    chunks = plan_chunks(args, units)
+    outputs = []
+    with ThreadPoolExecutor(max_workers=args.j) as pool:
+        futures = {unit.name: pool.submit(build_unit, args, unit, lstserial, profiler, \
+            cachedir) for unit in units}
+        pdfs = {}
+        # each part is put on paper as soon as its units are done,
+        # while the units of the next parts are still being compiled
+        for number, chunk in enumerate(chunks, 1):
+            # units that ran out of memory come back in parts
+            chunk = [part for unit in chunk for part in futures[unit.name].result()]
+            pdfs.update((unit.name, pdf) for unit, pdf in chunk)
+            chunk = [unit for unit, _ in chunk]
+            output = get_output_file(args, number if args.chunk else None)
+            file_print = f'2-print-{number:03d}' if args.chunk else '2-print'
+            if args.direct and len(chunk) == 1:
+                # the bills are on the paper already
+                pdf = get_unit_pdf(pdfs[chunk[0].name])
+                if pdf.parent == args.workdir:
+                    move_atomic(pdf, output)
+                else: # cached
+                    copy_atomic(pdf, output)
+            else:
+                build_printable_doc(args, chunk, pdfs, profiler, cachedir, file_print, output)
+
+            for unit in chunk:
+                remove_files(args.workdir/unit.name, ["aux", "pdf", "log", "tex", "xwm"])
+            remove_files(args.workdir/file_print, ["aux", "pdf", "log", "tex"])
+            if args.chunk:
+                print(f'**** Part {number} of {len(chunks)} is ready: {output}')
+            outputs.append(output)
+    return outputs
+
+
+def build(config, workdir=None):
+    """
+        Makes the money set of config (a Config) and returns the pdf written
+        (with -chunk, the first part). Raises BuildError if that fails.
+    """
+    args = copy.copy(config) # main() changes some of the settings
+    try:
+        return main(args, get_defaults(), workdir)[0]
+    except SystemExit as err:
+        raise BuildError(f'Making {config.out} failed') from err
+
+
+def read_manifest(file_manifest):
+    """
+        Returns the job settings (list of dicts) of a -batch manifest,
+        each updated by the manifest's "defaults"
+    """
+    import json
+    path = DIR_PATH/file_manifest
+    try:
+        if path.suffix.lower() == '.toml':
+            import tomllib # Python 3.11+
+            with open(path, 'rb') as toml_file:
+                manifest = tomllib.load(toml_file)
+        else:
+            with open(path, 'r', encoding='utf8') as json_file:
+                manifest = json.load(json_file)
+    except ImportError:
+        print(f'Reading {file_manifest} requires Python 3.11 or newer (tomllib)')
+        sys.exit(1)
+    except (OSError, ValueError) as err:
+        print(f'Cannot read batch manifest {file_manifest}: {err}')
+        sys.exit(1)
+
+    if isinstance(manifest, list):
+        manifest = {'jobs': manifest}
+    defaults = manifest.get('defaults', {})
+    return [dict(defaults, **job) for job in manifest.get('jobs', [])]
+
+
+def get_job_argv(job):
+    """
+        Command line of a batch job: {"bv": [1, 5], "frontback": true} -> -bv 1 5 -frontback
+    """
+    argv = []
+    for key, value in job.items():
+        if key == 'name':
+            continue
+        option = '-' + key.lstrip('-')
+        if value is True:
+            argv.append(option)
+        elif value is False or value is None:
+            continue
+        elif isinstance(value, (list, tuple)):
+            argv += [option] + [str(item) for item in value]
+        else:
+            argv += [option, str(value)]
+    return argv
+
+
+def parse_job(name, job, all_defargs, parser):
+    """
+        Settings of a -batch or -serve job, checked the same way as the command
+        line. Exits if they aren't valid.
+    """
+    # the default seed is drawn once per process, each set gets its own
+    job.setdefault('sns', random.randint(0, MAXIMUM))
+    job_args = parser.parse_args(get_job_argv(job))
+    if job_args.batch or job_args.serve or job_args.distribute or job_args.worker:
+        print(f'Job {name}: -batch, -serve, -distribute and -worker are not allowed in a job')
+        sys.exit(1)
+    args_validator(job_args, all_defargs)
+    return job_args
+
+
+def get_batch_jobs(args, all_defargs, parser):
+    """
+        Parses and validates every job of the -batch manifest, the same way as the
+        command line. Returns [(name, args or None, message)].
+    """
+    jobs = []
+    names = set()
+    outputs = set()
+    for number, job in enumerate(read_manifest(args.batch), 1):
+        name = str(job.get('name', f'job{number}'))
+        job.setdefault('out', name + '.pdf')
+        for key in ('workdir', 'events', 'progressrate'):
+            job.setdefault(key, getattr(args, key))
+        try:
+            job_args = parse_job(name, job, all_defargs, parser)
+            if name in names:
+                print(f'Job {name}: there is another job with this name')
+                sys.exit(1)
+            if get_output_file(job_args) in outputs:
+                print(f'Job {name}: {job_args.out} is written by another job already')
+                sys.exit(1)
+        except SystemExit:
+            jobs.append((name, None, 'invalid settings'))
+            continue
+        names.add(name)
+        outputs.add(get_output_file(job_args))
+        jobs.append((name, job_args, ''))
+    return jobs
+
+
+def run_batch_job(args, all_defargs):
+    """
+        Makes the money set of one batch job (in a workdir of its own)
+    """
+    tstart = time.perf_counter()
+    main(args, all_defargs)
+    return time.perf_counter() - tstart
+
+
+def run_batch(args, all_defargs, parser):
+    """
+        Runs all jobs of the -batch manifest, -batchjobs at the same time.
+        Images and the cache are shared by all jobs.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    jobs = get_batch_jobs(args, all_defargs, parser)
+    # by the number of the job, names can be there twice (the second one is invalid)
+    status = {number: 'FAILED: ' + message for number, (_, job_args, message) \
+        in enumerate(jobs) if job_args is None}
+
+    with ThreadPoolExecutor(max_workers=max(1, args.batchjobs)) as pool:
+        futures = {number: pool.submit(run_batch_job, job_args, all_defargs) \
+            for number, (_, job_args, _) in enumerate(jobs) if job_args is not None}
+        for number, future in futures.items():
+            try:
+                status[number] = f'done: {jobs[number][1].out} ({future.result():.1f} s)'
+            except SystemExit:
+                status[number] = 'FAILED'
+            except Exception as err: # pylint: disable=broad-except
+                status[number] = f'FAILED: {err}'
+
+    print('')
+    for number, (name, _, _) in enumerate(jobs):
+        print(f'**** [{name}] {status[number]}')
+    failed = sum(value.startswith('FAILED') for value in status.values())
+    print(f'**** Batch: {len(jobs) - failed} of {len(jobs)} jobs done.')
+    if failed:
+        sys.exit(1)
+
+
+class JobQueue:
+    """
+        Lets 'jobs' jobs run at the same time and up to 'waiting' more wait for their turn
+    """
+
+    def __init__(self, jobs, waiting):
+        self._slots = threading.Semaphore(max(1, jobs))
+        self._lock = threading.Lock()
+        self._limit = max(1, jobs) + max(0, waiting)
+        self.pending = 0
+
+    def enter(self):
+        """ waits for a free slot. False (at once) if too many jobs are waiting """
+        with self._lock:
+            if self.pending >= self._limit:
+                return False
+            self.pending += 1
+        self._slots.acquire() # pylint: disable=consider-using-with
+        return True
+
+    def leave(self):
+        """ frees the slot taken by enter() """
+        self._slots.release()
+        with self._lock:
+            self.pending -= 1
+
+
+# the only settings a -serve request can have: none of them runs a command or
+# writes to a path of the client's choice
+SERVE_SETTINGS = ('d', 'pc', 'ps', 'bpp', 'col', 'width', 'height', 'dupoff', 's', 'sb', \
+    'sns', 'sn', 'snlegacy', 'snoff', 'fsize', 'font', 'snh', 'folder', 'frontback', 'front', \
+    'back', 'snboffset', 'nop', 'bv', 'rec', 'pages', 'bills', 'cache', 'onepass', 'backend', \
+    'direct', 'embedeach', 'dpi', 'imgquality', 'format', 'maxpages')
+
+
+def check_serve_job(job):
+    """
+        Message why the settings of a -serve request aren't allowed, or None if they are
+    """
+    unknown = [key for key in job if key.lstrip('-') not in SERVE_SETTINGS]
+    if unknown:
+        return 'not allowed: ' + ', '.join(unknown)
+    for key in ('folder', 'front', 'back'):
+        value = str(job.get(key, ''))
+        if os.path.isabs(value) or '..' in Path(value).parts or \
+                (key != 'folder' and ('/' in value or os.sep in value)):
+            return f'{key} has to be inside the folder of make_money.py'
+    return None
+
+
+def run_server(args, all_defargs, parser):
+    """
+        -serve: makes a money set for every POST /build request and sends back the pdf.
+        Parser, images and preambles stay in memory between requests.
+    """
+    # pylint: disable=too-many-locals,too-many-statements
+    import json
+    import tempfile
+    import socketserver
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    queue = JobQueue(args.servejobs, args.servequeue)
+    base = get_workdir_base(args)
+    counter = iter(range(1, MAXIMUM))
+
+    class MoneyRequestHandler(BaseHTTPRequestHandler):
+        """ POST /build: JSON settings -> pdf, GET /status: number of pending jobs """
+
+        def address_string(self):
+            return self.client_address[0] if self.client_address else 'local'
+
+        def send_text(self, code, text, content_type='text/plain'):
+            """ sends a short answer """
+            body = (text + '\n').encode('utf8')
+            self.send_response(code)
+            self.send_header('Content-Type', content_type + '; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self): # pylint: disable=invalid-name
+            """ status """
+            if self.path != '/status':
+                self.send_text(404, 'Not found, use GET /status or POST /build')
+                return
+            self.send_text(200, json.dumps({'pending': queue.pending}), 'application/json')
+
+        def do_POST(self): # pylint: disable=invalid-name
+            """ makes a money set """
+            # pylint: disable=too-many-return-statements,too-many-branches
+            if self.path != '/build':
+                self.send_text(404, 'Not found, use POST /build')
+                return
+            # a web page can't send this cross-site without asking first
+            content_type = self.headers.get('Content-Type', '').split(';')[0].strip()
+            if content_type.lower() != 'application/json':
+                self.send_text(415, 'Send the settings as application/json')
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                job = json.loads(self.rfile.read(length) or b'{}')
+                if not isinstance(job, dict):
+                    raise ValueError('expected a JSON object')
+            except ValueError as err:
+                self.send_text(400, f'Invalid request: {err}')
+                return
+            message = check_serve_job(job)
+            if message:
+                self.send_text(400, f'Invalid settings: {message}')
+                return
+
+            name = f'{next(counter):06d}'
+            job['events'], job['progressrate'] = args.events, args.progressrate
+            try:
+                job_args = parse_job(name, job, all_defargs, parser)
+            except SystemExit:
+                self.send_text(400, 'Invalid settings')
+                return
+
+            if not queue.enter():
+                self.send_text(503, 'Too many jobs, try again later')
+                return
+            workdir = Path(tempfile.mkdtemp(prefix=f'make_money-{name}-', dir=base))
+            job_args.out = str(workdir/'yourMoney.pdf')
+            pdf = None
+            try:
+                pdf = main(job_args, all_defargs, workdir)[0]
+            except SystemExit:
+                pass
+            except Exception as err: # pylint: disable=broad-except
+                print(f'**** Job {name} failed: {err!r}')
+            finally:
+                queue.leave()
+            if pdf is None:
+                self.send_text(500, 'Making the money set failed')
+                rmtree(workdir, ignore_errors=True)
+                return
+
+            try:
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/pdf')
+                self.send_header('Content-Length', str(pdf.stat().st_size))
+                self.end_headers()
+                with open(pdf, 'rb') as pdf_file:
+                    for block in iter(lambda: pdf_file.read(1 << 20), b''):
+                        self.wfile.write(block)
+            finally:
+                rmtree(workdir, ignore_errors=True)
+
+    if '/' in args.serve or os.sep in args.serve:
+        class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            """ HTTP on a Unix socket """
+            daemon_threads = True
+        try:
+            os.remove(args.serve) # left over from the last time
+        except FileNotFoundError:
+            pass
+        server = UnixHTTPServer(args.serve, MoneyRequestHandler)
+    else:
+        host, _, port = args.serve.rpartition(':')
+        server = ThreadingHTTPServer((host or '127.0.0.1', int(port)), MoneyRequestHandler)
+
+    print(f'**** Serving on {args.serve}, {args.servejobs} job(s) at a time. Ctrl+C to stop.')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+# settings that aren't part of a -distribute job
+DIST_SETTINGS = ('distribute', 'worker', 'distsheets', 'distworkers', 'distlease', \
+    'distretries')
+
+# settings of a -distribute job that every worker takes from its own command line
+HOST_SETTINGS = ('engine', 'workdir', 'j', 'cache', 'cachedir', 'format', 'maxpages', \
+    'events', 'progressrate', 'profile', 'profilejson')
+
+
+def claim_task(queue):
+    """
+        Takes the first task of queue/todo (moves it to queue/claimed).
+        Returns the claimed file, or None if there is no task left.
+    """
+    for todo in sorted((queue/'todo').glob('*.json')):
+        claimed = queue/'claimed'/todo.name
+        try:
+            os.rename(todo, claimed) # only one worker gets it
+        except OSError:
+            continue
+        os.utime(claimed) # the lease starts now
+        return claimed
+    return None
+
+
+def release_task(queue, claimed, retries, reason):
+    """
+        Gives a claimed task back to queue/todo, or to queue/failed after retries
+        more attempts
+    """
+    import json
+    releasing = claimed.with_name(f'{claimed.name}.{os.getpid()}.release')
+    try:
+        os.rename(claimed, releasing) # only one worker or coordinator does it
+    except OSError:
+        return
+    task = json.loads(releasing.read_text(encoding='utf8'))
+    task['attempts'] += 1
+    task['reason'] = reason
+    target = queue/('failed' if task['attempts'] > retries else 'todo')/claimed.name
+    tmpfile = target.with_name(target.name + f'.{os.getpid()}.tmp')
+    tmpfile.write_text(json.dumps(task), encoding='utf8')
+    os.replace(tmpfile, target)
+    os.remove(releasing)
+    print(f'**** Task {claimed.stem}: {reason}, ' + \
+        ('given up' if target.parent.name == 'failed' else 'to be done again'))
+
+
+def release_expired_tasks(queue, lease, retries):
+    """
+        Gives back the tasks of workers that haven't shown for lease seconds
+    """
+    now = time.time()
+    for claimed in (queue/'claimed').glob('*.json'):
+        try:
+            stat = claimed.stat()
+        except OSError:
+            continue
+        # the worker touches the file while it works, rename sets ctime as well
+        if now - max(stat.st_mtime, stat.st_ctime) > lease:
+            release_task(queue, claimed, retries, 'the worker is gone')
+
+
+def run_task(name, claimed, settings, args, all_defargs, parser):
+    """
+        Makes the sheets of a claimed task into queue/done/<task>.pdf, touching the
+        claimed file every now and then, so its lease doesn't expire. True if done.
+    """
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    import json
+    queue = claimed.parent.parent
+    task = json.loads(claimed.read_text(encoding='utf8'))
+    job = dict(settings['job'])
+    job['pages'] = f'{2 * task["first"] + 1}-{2 * task["last"]}'
+    job['out'] = str(queue/'done'/(claimed.stem + '.pdf'))
+    job['spool'] = None
+    for key in HOST_SETTINGS:
+        job[key] = getattr(args, key)
+
+    stop = threading.Event()
+    def keep_lease():
+        while not stop.wait(settings['lease'] / 4):
+            try:
+                os.utime(claimed)
+            except OSError:
+                return
+
+    heartbeat = threading.Thread(target=keep_lease, daemon=True)
+    heartbeat.start()
+    try:
+        main(parse_job(name, job, all_defargs, parser), all_defargs)
+    except SystemExit:
+        release_task(queue, claimed, settings['retries'], f'failed on {name}')
+        return False
+    finally:
+        stop.set()
+        heartbeat.join()
+    try:
+        os.remove(claimed)
+    except FileNotFoundError: # the lease expired, another worker does it again
+        pass
+    return True
+
+
+def run_worker(args, all_defargs, parser):
+    """
+        -worker: makes the tasks of the -distribute queue, until none are left
+    """
+    import json
+    import socket
+    queue = DIR_PATH/args.worker
+    name = f'{socket.gethostname()}-{os.getpid()}'
+    print(f'**** Worker {name}: waiting for tasks in {queue}')
+    while not (queue/'job.json').is_file():
+        time.sleep(1)
+    with open(queue/'job.json', 'r', encoding='utf8') as json_file:
+        settings = json.load(json_file)
+
+    done = 0
+    while (queue/'job.json').is_file():
+        claimed = claim_task(queue)
+        if claimed is not None:
+            done += run_task(name, claimed, settings, args, all_defargs, parser)
+            continue
+        release_expired_tasks(queue, settings['lease'], settings['retries'])
+        if not any((queue/'todo').glob('*.json')) and \
+                not any((queue/'claimed').glob('*.json')):
+            break
+        time.sleep(1)
+    print(f'**** Worker {name}: {done} task(s) done')
+
+
+def run_coordinator(args, all_defargs, parser):
+    """
+        -distribute: splits the money set into tasks of -distsheets sheets, waits
+        until the workers have made all of them and puts them together
+    """
+    # pylint: disable=too-many-locals
+    import json
+    import subprocess
+    # the job as the workers get it: everything that was set, and the seed
+    job = {key: value for key, value in vars(args).items() \
+        if value != all_defargs[key] and key not in DIST_SETTINGS}
+    job['sns'] = args.sns
+    job_args = parse_job('distribute', dict(job), all_defargs, parser)
+    if job_args.registry or job_args.sheets is not None or job_args.chunk:
+        print('-distribute does not work with -registry, -pages, -bills and -chunk')
+        sys.exit(1)
+
+    queue = DIR_PATH/args.distribute
+    if (queue/'job.json').exists():
+        print(f'There is a job in {queue} already')
+        sys.exit(1)
+    for folder in ('todo', 'claimed', 'done', 'failed', 'logs'):
+        (queue/folder).mkdir(parents=True, exist_ok=True)
+
+    sheets = 1 if job_args.pc else sum(job_args.nop)
+    step = max(1, args.distsheets)
+    tasks = []
+    for first in range(0, sheets, step):
+        tasks.append(f'{len(tasks) + 1:06d}')
+        (queue/'todo'/(tasks[-1] + '.json')).write_text(json.dumps({'first': first, \
+            'last': min(first + step, sheets), 'attempts': 0}), encoding='utf8')
+    tmpfile = queue/f'job.json.{os.getpid()}.tmp'
+    tmpfile.write_text(json.dumps({'job': job, 'tasks': len(tasks), \
+        'lease': args.distlease, 'retries': args.distretries}, indent=2), encoding='utf8')
+    os.replace(tmpfile, queue/'job.json') # now the workers start
+
+    workers = []
+    for number in range(args.distworkers):
+        with open(queue/'logs'/f'worker-{number + 1}.log', 'w', encoding='utf8') as log:
+            # pylint: disable-next=consider-using-with
+            workers.append(subprocess.Popen([sys.executable, str(Path(__file__).resolve()), \
+                '-worker', str(queue), '-engine', args.engine] + \
+                (['-workdir', args.workdir] if args.workdir else []), \
+                stdout=log, stderr=subprocess.STDOUT))
+    print(f'**** {len(tasks)} task(s) of {step} sheets in {queue}, '\
+        f'{len(workers)} worker(s) started here')
+
+    progress = Progress(args.events, args.progressrate, args.out)
+    try:
+        while True:
+            done = sum((queue/'done'/(task + '.pdf')).is_file() for task in tasks)
+            progress.update('tasks', done, len(tasks))
+            if done == len(tasks):
+                break
+            failed = sorted(path.stem for path in (queue/'failed').glob('*.json'))
+            if failed or (workers and all(worker.poll() is not None for worker in workers)):
+                print(f'**** Failed: task(s) {", ".join(failed) or "-"}, the files (and '\
+                    f'the logs of the workers) are kept in {queue}')
+                sys.exit(1)
+            release_expired_tasks(queue, args.distlease, args.distretries)
+            time.sleep(1)
+        progress.finish('tasks', len(tasks))
+    finally:
+        progress.close()
+
+    os.remove(queue/'job.json') # the workers stop
+    for worker in workers:
+        worker.wait()
+    main(args, all_defargs)
+    rmtree(queue, ignore_errors=True)
+
+
+def join_parts(args, profiler):
+    """
+        Puts the parts made by the -distribute workers together, in order.
+        Returns the pdf written.
+    """
+    parts = sorted((DIR_PATH/args.distribute/'done').glob('*.pdf'))
+    output = get_output_file(args)
+    if args.spool:
+        output.parent.mkdir(parents=True, exist_ok=True)
+    if len(parts) == 1:
+        copy_atomic(parts[0], output)
+        return output
+
+    # the parts are on paper already, as with -direct
+    join_args = copy.copy(args)
+    join_args.direct = True
+    units = [BillUnit(part.stem, None, 0, 0) for part in parts]
+    build_printable_doc(join_args, units, {part.stem: tex_path(part) for part in parts}, \
+        profiler, None, '2-join', output)
+    remove_files(args.workdir/'2-join', ["aux", "pdf", "log", "tex"])
+    return output
+
+
+# Print iterations progress
+def print_progress_bar(iteration, total, prefix=''):
+    """
+    Call in a loop to create terminal progress bar
+    @params:
+        iteration   - Required  : current iteration (Int)
+        total       - Required  : total iterations (Int)
+        prefix      - Optional  : prefix string (Str)
+        suffix      - Optional  : suffix string (Str)
+        decimals    - Optional  : positive number of decimals in percent complete (Int)
+        length      - Optional  : character length of bar (Int)
+        fill        - Optional  : bar fill character (Str)
+    """
+    suffix = ''
+    decimals = 1
+    length = 50 # int((os.get_terminal_size(1).columns - 20) / 2)
+    fill = '█'
+
+    percent = ("{0:." + str(decimals) + "f}").format(100 * (iteration / float(total)))
+    filledlength = int(length * iteration // total)
+    pbar = fill * filledlength + '-' * (length - filledlength)
+    # print('\r%s |%s| %s%% %s' % (prefix, pbar, percent, suffix), end='\r')
+    print(f'\r{prefix} |{pbar}| {percent}% {suffix}', end='\r')
+    # Print New Line on Complete
+    if iteration == total:
+        print()
+
+
+class SerialPermutation:
+    """
+        Keyed bijection on range(size).
+        A balanced Feistel network on the next even number of bits, cycle-walking
+        back into range. Same seed and size give the same permutation.
+    """
+
+    def __init__(self, seed, size):
+        bits = max(2, (size - 1).bit_length())
+        bits += bits % 2
+        self._size = size
+        self._half = bits // 2
+        self._mask = (1 << self._half) - 1
+        rng = random.Random(seed)
+        self._keys = [rng.getrandbits(32) for _ in range(4)]
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, index):
+        if not 0 <= index < self._size:
+            raise IndexError('serial permutation index out of range')
+        return next(self.values(index, index + 1))
+
+    def values(self, start=0, stop=None):
+        """ yields the permuted values of the indices start..stop-1 """
+        size = self._size
+        stop = size if stop is None else min(stop, size)
+        half = self._half
+        mask = self._mask
+        key0, key1, key2, key3 = self._keys
+        for value in range(start, stop):
+            while True:
+                left = value >> half
+                right = value & mask
+                left ^= (((right ^ key0) * 0x9E3779B1) >> 7) & mask
+                right ^= (((left ^ key1) * 0x9E3779B1) >> 7) & mask
+                left ^= (((right ^ key2) * 0x9E3779B1) >> 7) & mask
+                right ^= (((left ^ key3) * 0x9E3779B1) >> 7) & mask
+                value = (left << half) | right
+                if value < size:
+                    break
+            yield value
+
+
+class SerialStream:
+    """
+        The serial numbers of a job, computed from the permutation when they are
+        needed instead of being kept: bill n gets snmin + perm[n].
+    """
+
+    def __init__(self, perm, snmin, count):
+        self._perm = perm
+        self._snmin = snmin
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, bill):
+        if not 0 <= bill < self._count:
+            raise IndexError('serial index out of range')
+        return self._snmin + self._perm[bill]
+
+    def __iter__(self):
+        return self.values(0, self._count)
+
+    def values(self, start, stop):
+        """ yields the serial numbers of the bills start..stop-1 """
+        snmin = self._snmin
+        return (snmin + value for value in self._perm.values(start, min(stop, self._count)))
+
+
+class SerialRegistry:
+    """
+        Serial numbers issued so far: bit n of the (memory mapped) file is set if
+        serial number n is. The file is locked while it's open.
+    """
+
+    def __init__(self, path):
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        self._map = None
+        self.reserve(MAXIMUM)
+
+    def reserve(self, serial):
+        """ makes the file big enough for all serial numbers up to serial """
+        size = (serial >> 3) + 1
+        if self._map is not None and len(self._map) >= size:
+            return
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        if self._map is not None:
+            self._map.close()
+        self._map = mmap.mmap(self._fd, os.fstat(self._fd).st_size)
+
+    def __contains__(self, serial):
+        index = serial >> 3
+        return index < len(self._map) and bool(self._map[index] >> (serial & 7) & 1)
+
+    def add(self, serials):
+        """ marks serials as issued """
+        regmap = self._map
+        for serial in serials:
+            regmap[serial >> 3] |= 1 << (serial & 7)
+
+    def close(self):
+        """ writes the changes and unlocks the file """
+        self._map.flush()
+        self._map.close()
+        os.close(self._fd) # releases the lock
+
+
+@contextmanager
+def open_registry(args):
+    """
+        The SerialRegistry of -registry, or None. Not with -s, -pc and -d: no serial
+        numbers of the set are printed, so none are drawn from or added to it.
+    """
+    if not args.registry:
+        yield None
+        return
+    if args.s or args.pc or args.d:
+        print(f'**** {args.registry} is not used, no serial numbers of the set are printed')
+        yield None
+        return
+    registry = SerialRegistry(DIR_PATH/args.registry)
+    try:
+        yield registry
+    finally:
+        registry.close()
+
+
+def get_serial_range(args, itotalallbills):
+    """
+        Returns the (first, last) serial number that can be drawn. The range is
+        extended if it's too small for the number of bills.
+    """
+    newmaxsn = args.sn[1]
+    if itotalallbills > (args.sn[1] - args.sn[0]):
+        newmaxsn = args.sn[1] + args.sn[0] + itotalallbills
+    return args.sn[0], newmaxsn
+
+
+def get_random_list(args, registry=None):
+    """
+        Draws one unique serial number per bill.
+        Serials are a keyed permutation of the serial range (seeded by -sns),
+        so this is linear in the number of bills. With -snlegacy, the serials of
+        older versions are reproduced. Serials in registry are skipped.
+        For -pages/-bills, only the serials of the bills on those sheets are
+        returned (bill -> serial), computed directly from the permutation.
+        Without a registry, a SerialStream is returned: the serials are only
+        computed while the bills are written, so memory stays the same for any
+        number of bills.
+    """
+
+    itotalallbills = sum(args.nop) * args.bpp
+    # print(f'\n### Total Bills: {str(itotalallbills)}\n')
+
+    snmin, newmaxsn = get_serial_range(args, itotalallbills)
+    lstserial = array('I' if newmaxsn < 2**32 else 'Q')
+
+    print()
+
+    if args.snlegacy:
+        # same sequence as random.seed(), without touching the shared generator
+        rng = random.Random(args.sns)
+        seen = set()
+        while len(lstserial) < itotalallbills:
+            rnd = rng.randint(snmin, newmaxsn)
+            if rnd not in seen:
+                seen.add(rnd)
+                lstserial.append(rnd)
+                if not len(lstserial) % PROGRESS_STEP:
+                    args.progress.update('serials', len(lstserial), itotalallbills)
+        args.progress.finish('serials', itotalallbills)
+        return lstserial
+
+    perm = SerialPermutation(args.sns, newmaxsn - snmin + 1)
+    if args.sheets is not None:
+        return {bill: snmin + perm[bill] for sheet in args.sheets \
+            for bill in range(sheet * args.bpp, (sheet + 1) * args.bpp)}
+
+    if registry is None:
+        args.progress.finish('serials', itotalallbills)
+        return SerialStream(perm, snmin, itotalallbills)
+
+    registry.reserve(newmaxsn)
+    for value in perm.values():
+        if len(lstserial) == itotalallbills:
+            break
+        if snmin + value not in registry:
+            lstserial.append(snmin + value)
+            if not len(lstserial) % PROGRESS_STEP:
+                args.progress.update('serials', len(lstserial), itotalallbills)
+
+    if len(lstserial) < itotalallbills:
+        print(f'\nOnly {len(lstserial)} serial numbers between {snmin} and {newmaxsn} '\
+            f'are not in {args.registry} yet, {itotalallbills} are needed')
+        sys.exit(1)
+    args.progress.finish('serials', itotalallbills)
+    return lstserial
+
+
+def get_bill_images(args, lbv):
+    """
+        Returns the front and back image of bill value lbv, as passed to includegraphics
+        (the scaled image, if there is one)
+    """
+    return tuple(args.images.get(image, image) for image in get_source_images(args, lbv))
+
+
+def get_source_images(args, lbv):
+    """
+        Returns the front and back image of bill value lbv as given by the settings
+    """
+    if args.d:
+        return 'example-image-a', 'example-image-b'
+    if args.frontback:
+        return args.folder + '/' + args.front + '-' + lbv, args.folder + '/' + args.back + '-' + lbv
+    return args.folder + '/money-' + lbv, args.folder + '/money-' + lbv
+
+
+def count_bills(args, unit=None):
+    """
+        Number of bills written for unit (all bills if None)
+    """
+    return sum(cntlast - cntfirst for _, cntfirst, cntlast in get_bill_ranges(args, unit))
+
+
+def get_bill_ranges(args, unit=None):
+    """
+        Returns (index of bill value, first bill, last bill + 1) of the bills in unit.
+        Bills are counted over the whole job. For a unit of all bill values (or
+        without a unit) all of them are returned, even those without any pages.
+    """
+    billfirst = 0
+    billlast = sum(args.nop) * args.bpp
+    if unit is not None:
+        billfirst = unit.first * args.bpp
+        billlast = (unit.first + unit.pages) * args.bpp
+
+    ranges = []
+    cnt = 0
+    for i, nop in enumerate(args.nop, 0):
+        itotalbills = nop * args.bpp # total bills of current value
+        cntfirst = max(cnt, billfirst)
+        cntlast = min(cnt + itotalbills, billlast)
+        cnt += itotalbills
+        if unit is None or unit.index is None or cntfirst < cntlast:
+            ranges.append((i, cntfirst, max(cntfirst, cntlast)))
+    return ranges
+
+
+def iter_serials(lstserial, cntfirst, cntlast):
+    """
+        Yields the serial numbers of the bills cntfirst..cntlast-1, from a SerialStream,
+        the list or the bill -> serial dict of -pages
+    """
+    if isinstance(lstserial, SerialStream):
+        return lstserial.values(cntfirst, cntlast)
+    return map(lstserial.__getitem__, range(cntfirst, cntlast))
+
+
+def format_serial(args, serial, padlen):
+    """
+        Serial number as printed on the bill
+    """
+    if args.snh:
+        return f'{serial:02X}'
+    return str(serial).zfill(padlen)
+
+
+def create_tex_main(args, file_bills, lstserial, unit=None):
+    """
+        Creates the bills with the serial numbers. One bill per page.
+        If a unit is given, only the bills of that unit are written.
+    """
+    # pylint: disable=too-many-locals
+
+    out = open(file_bills, 'w', encoding='utf8', newline='\n') # pylint: disable=consider-using-with
+    out.write(r'\documentclass{article}'+'\n')
+    out.write(f'\\usepackage[paperheight={args.height}mm, paperwidth={args.width}mm, margin=0pt]'\
+              + '{geometry}'+'\n')
+
+    if args.onepass:
+        out.write(r'\usepackage{graphicx}'+'\n')
+    else:
+        out.write(r'\usepackage{tikz}'+'\n')
+        out.write(r'\usetikzlibrary{positioning}'+'\n')
+
+    get_serialnumber_setting(args, out)
+
+    out.write(r'\pagestyle{empty}'+'\n')
+    out.write(r'\begin{document}'+'\n')
+
+    lbillvalues = args.bv
+
+    print('\n')
+
+    padlen = len(str(args.sn[1]))
+
+    task = 'bills ' + Path(file_bills).stem
+    total = count_bills(args, unit)
+    done = 0
+    shared = get_shared_sides(args)
+
+    for i, cntfirst, cntlast in get_bill_ranges(args, unit):
+
+        lbv = str(lbillvalues[i])
+        out.write(f"% % % {lbv}\n")
+
+        front, back = get_bill_images(args, lbv)
+
+        if 'front' in shared:
+            # all bills of this value are the same, see plan_bill_pages
+            if cntfirst < cntlast:
+                out.write(r' \mypics{' + front + r'}{' + back + r'}{}{}'+'\n')
+            done += cntlast - cntfirst
+            continue
+
+        # the line of every bill of this value is prefix + serial number + '}'
+        if args.d:
+            prefix = r'\mypics{' + front + '}{' + back + '}{' + lbv + '}{'
+        else:
+            prefix = r' \mypics{' + front + r'}{' + back + r'}{}{'
+        if args.s and not args.d:
+            snums = ('' for _ in range(cntfirst, cntlast))
+        else:
+            snums = (format_serial(args, serial, padlen) \
+                for serial in iter_serials(lstserial, cntfirst, cntlast))
+
+        if shared and cntfirst < cntlast:
+            # the back of the first bill is used for all of them
+            out.write(prefix + next(snums) + '}\n')
+            prefix = r' \myfront{' + front + r'}{}{}{'
+            done += 1
+
+        # written in batches of PROGRESS_STEP bills
+        while batch := [prefix + snum + '}\n' for snum in islice(snums, PROGRESS_STEP)]:
+            out.write(''.join(batch))
+            done += len(batch)
+            args.progress.update(task, done, total)
+
+        out.write('\n\n')
+
+    out.write(r'\end{document}'+'\n')
+    out.close()
+    args.progress.finish(task, total)
+
+
+def print_serialnumbers(args, out, xyf, strdebug):
+    """
+        do this, if the user wants serial numbers on front and back
+    """
+
+    debugtext = ''
+    debugnode = ''
+    if args.d:
+        debugtext = r', text=black, font=\bfseries'
+        debugnode = '\t'+r'\node[opacity=.35] at (thispage.center) '
+    else:
+        debugnode = '\t'+r'\node at (thispage.center) '
+
+    out.write(r'\newcommand{\mypics}[4]{'+'\n'\
+        r'  \begin{tikzpicture}[remember picture,overlay]'+'\n'\
+        '\t'+r'\node (thispage) [shape=rectangle'\
+        r', minimum height=\paperheight, minimum width=\paperwidth, anchor=center] '\
+        r'at (current page.center) {};'+'\n')
+
+    out.write(debugnode)
+    out.write(r'{\billimg{#1}};'+'\n'\
+        '\t'+r'\node[xshift='+\
+        str(xyf.shiftx) + r'mm, yshift=' + str(xyf.shifty) + r'mm' + debugtext +\
+        r'] at (thispage.center) '\
+        r'{\thisfontsfamily' + strdebug + r'#4};'+'\n'\
+        r'  \end{tikzpicture}'+'\n'\
+        r'  \newpage'+'\n'\
+        r'  \begin{tikzpicture}[remember picture, overlay]'+'\n'\
+        '\t'+r'\node (thispage) [shape=rectangle, minimum height=\paperheight, '\
+        r'minimum width=\paperwidth, anchor=center] at (current page.center) {};'+'\n')
+
+    out.write(debugnode)
+    out.write(r'{\billimg{#2}};'+'\n'\
+        '\t'+r'\node[xshift=' + str(xyf.shiftbx) + r'mm, yshift=' + str(xyf.shiftby) + r'mm' +\
+        debugtext + r'] at '\
+        r'(thispage.center) {\thisfontsfamily' + strdebug + r'#4};'+'\n'\
+        r'  \end{tikzpicture}'+'\n'+r'  \newpage'+'\n}'+'\n')
+
+
+def print_no_serial_on_backside(out, xyf, strdebug):
+    """
+        do this, if the user doesn't want serial numbers on the back of the bills
+    """
+    front = r'  \begin{tikzpicture}[remember picture,overlay]'+'\n'\
+        '\t'+r'\node (thispage) [shape=rectangle'\
+        r', minimum height=\paperheight, minimum width=\paperwidth, anchor=center] '\
+        r'at (current page.center) {};'+'\n'\
+        '\t'+r'\node at (thispage.center) '\
+        r'{\billimg{#1}};'+'\n'\
+        '\t'+r'\node[xshift='+\
+        str(xyf.shiftx) + r'mm, yshift=' + str(xyf.shifty) + r'mm] at (thispage.center) '\
+        r'{\thisfontsfamily' + strdebug + r'#4};'+'\n'\
+        r'  \end{tikzpicture}'+'\n'\
+        r'  \newpage'+'\n'
+
+    # the front only, for the bills that share the back of the first one
+    out.write(r'\newcommand{\myfront}[4]{'+'\n' + front + '}\n')
+
+    # if serial number on front and back
+    out.write(r'\newcommand{\mypics}[4]{'+'\n' + front + \
+        r'  \begin{tikzpicture}[remember picture,overlay]'+'\n'\
+        '\t'+r'\node (thispage) [shape=rectangle, minimum height=\paperheight, '\
+        r'minimum width=\paperwidth, anchor=center] at (current page.center) {};'+'\n'\
+        '\t'+r'\node at '\
+        r'(thispage.center) {\billimg{#2}};'+'\n'\
+        r'  \end{tikzpicture}'+'\n'+r'  \newpage'+'\n}'+'\n')
 
 
 def print_no_serial(args, out):
@@ -707,7 +2628,7 @@ def print_no_serial(args, out):
         r', minimum height=\paperheight, minimum width=\paperwidth, anchor=center] '\
         r'at (current page.center) {};'+'\n'\
         '\t' + r'\node at (thispage.center) '\
-        r'{\includegraphics[width=\paperwidth, height=\paperheight]{#1}};'+'\n')
+        r'{\billimg{#1}};'+'\n')
     if args.d:
         out.write('\t'+r'\node [anchor=south] at (thispage.south) {\thectdebugger - #3};'+'\n')
     out.write(r'\end{tikzpicture}'+'\n')
@@ -719,7 +2640,7 @@ def print_no_serial(args, out):
         r'minimum height=\paperheight, '\
         r'minimum width=\paperwidth, anchor=center] at (current page.center) {};'+'\n'\
         '\t' + r'\node at (thispage.center) '\
-        r'{\includegraphics[width=\paperwidth, height=\paperheight]{#2}};')
+        r'{\billimg{#2}};')
 
     if args.d:
         out.write(r'\node [anchor=south] at (thispage.south) {\thectdebugger - #3};'+'\n')
@@ -727,14 +2648,72 @@ def print_no_serial(args, out):
     out.write(r'\end{tikzpicture}'+'\n'+r'\newpage}'+'\n')
 
 
-def get_serialnumber_setting(args, out):
+def print_onepass_pics(args, out, xyf, strdebug):
+    r"""
+        Same \mypics as the ones above, but without tikz's remember picture: image
+        and label are put on the page by the shipout/background hook, which has its
+        origin in the top left corner of the page. Needs no second run.
     """
-        silly pylint - too many branches ... don't like big trees?!
+    width = float(args.width)
+    height = float(args.height)
+
+    out.write(r'\newcommand{\billpage}[4]{% image, label, x, y of label center'+'\n'\
+        r'  \AddToHookNext{shipout/background}{\setlength{\unitlength}{1mm}%'+'\n'\
+        r'    \put(0,' + str(-height) + r'){\billimg{#1}}%'+'\n'\
+        r'    \put(#3,#4){\makebox(0,0){#2}}}%'+'\n'\
+        r'  \null\newpage}'+'\n')
+
+    def label_at(shiftx, shifty):
+        return '{' + str(round(width / 2 + float(shiftx), 3)) + '}{' + \
+            str(round(-height / 2 + float(shifty), 3)) + '}'
+
+    front = label_at(xyf.shiftx, xyf.shifty)
+    back = label_at(xyf.shiftbx, xyf.shiftby)
+    south = label_at(0, -height / 2 + xyf.fontsize)
+
+    if not args.s and not args.sb:
+        out.write(r'\newcommand{\mypics}[4]{%'+'\n'\
+            r'  \billpage{#1}{\thisfontsfamily' + strdebug + r'#4}' + front + '%\n'\
+            r'  \billpage{#2}{\thisfontsfamily' + strdebug + r'#4}' + back + '}\n')
+    elif args.sb:
+        out.write(r'\newcommand{\myfront}[4]{%'+'\n'\
+            r'  \billpage{#1}{\thisfontsfamily' + strdebug + r'#4}' + front + '}\n')
+        out.write(r'\newcommand{\mypics}[4]{%'+'\n'\
+            r'  \billpage{#1}{\thisfontsfamily' + strdebug + r'#4}' + front + '%\n'\
+            r'  \billpage{#2}{}' + back + '}\n')
+    elif args.d:
+        out.write(r'\newcommand{\mypics}[3]{%'+'\n'\
+            r'  \billpage{#1}{#3}' + south + '%\n'\
+            r'  \billpage{#2}{#3}' + south + '}\n')
+    else:
+        out.write(r'\newcommand{\mypics}[2]{%'+'\n'\
+            r'  \billpage{#1}{}{0}{0}%'+'\n'\
+            r'  \billpage{#2}{}{0}{0}}'+'\n')
+
+
+def print_billimg(args, out, size=r'width=\paperwidth, height=\paperheight'):
+    r"""
+        \billimg{file}: the image stretched to the size of the bill.
+        Each image is put into a box the first time it's used, all further bills
+        just use that box, so the image is embedded only once into the pdf.
     """
+    if args.embedeach:
+        out.write(r'\newcommand{\billimg}[1]{\includegraphics[' + size + ']{#1}}'+'\n')
+        return
 
-    # get serialnumber settings from arguments
-    xyf = Serialnumber(args)
+    out.write(r'\newcommand{\billimg}[1]{%'+'\n'\
+        r'  \ifcsname billimg@#1\endcsname\else'+'\n'\
+        r'    \expandafter\newsavebox\csname billimg@#1\endcsname'+'\n'\
+        r'    \global\expandafter\setbox\csname billimg@#1\endcsname\hbox{%'+'\n'\
+        r'      \includegraphics[' + size + ']{#1}}%'+'\n'\
+        r'  \fi'+'\n'\
+        r'  \expandafter\usebox\csname billimg@#1\endcsname}'+'\n')
 
+
+def print_fontsfamily(args, out, xyf):
+    r"""
+        Font packages and \thisfontsfamily, the font of the serial number
+    """
     out.write(r'\usepackage[T1]{fontenc}'+'\n')
     out.write(r'\usepackage{emerald}'+'\n')
 
@@ -749,11 +2728,45 @@ def get_serialnumber_setting(args, out):
             str(xyf.fontsize) + r'mm}{' + str(xyf.fontsize + 1) + \
                 r'mm}\rmfamily\selectfont}'+'\n')
 
+
+# settings the preamble written by get_serialnumber_setting depends on
+PREAMBLE_SETTINGS = ('d', 's', 'sb', 'font', 'fsize', 'snoff', 'snboffset', 'width', \
+    'height', 'onepass', 'embedeach')
+
+_PREAMBLES = {}
+
+def get_serialnumber_setting(args, out):
+    r"""
+        Writes the fonts and the \mypics command. Made once for the same settings.
+    """
+    key = repr([getattr(args, name) for name in PREAMBLE_SETTINGS])
+    if key not in _PREAMBLES:
+        preamble = io.StringIO()
+        print_serialnumber_setting(args, preamble)
+        _PREAMBLES[key] = preamble.getvalue()
+    out.write(_PREAMBLES[key])
+
+
+def print_serialnumber_setting(args, out):
+    """
+        silly pylint - too many branches ... don't like big trees?!
+    """
+
+    # get serialnumber settings from arguments
+    xyf = Serialnumber(args)
+
+    print_fontsfamily(args, out, xyf)
+
     strdebug = ''
     if args.d:
         strdebug = r' \thisfontsfamily #3 -- '
 
-    if not args.s and not args.sb:
+    print_billimg(args, out)
+
+    if args.onepass:
+        # one run only, no tikz
+        print_onepass_pics(args, out, xyf, strdebug)
+    elif not args.s and not args.sb:
         # if serial number on front and back
         print_serialnumbers(args, out, xyf, strdebug)
     elif args.sb:
@@ -764,13 +2777,734 @@ def get_serialnumber_setting(args, out):
         print_no_serial(args, out)
 
 
+def probe_png(png_file):
+    """
+        Width, height, dpi (None if not given) and interlacing from the chunks before
+        the image data
+    """
+    width = height = dpi = interlaced = None
+    while True:
+        header = png_file.read(8)
+        if len(header) < 8:
+            break
+        length, ctype = struct.unpack('>I4s', header)
+        if ctype in (b'IDAT', b'IEND'):
+            break
+        if ctype == b'IHDR':
+            width, height, _, _, _, _, interlaced = struct.unpack('>IIBBBBB', \
+                png_file.read(length)[:13])
+        elif ctype == b'pHYs':
+            ppux, _, unit = struct.unpack('>IIB', png_file.read(length)[:9])
+            dpi = round(ppux * 0.0254) if unit == 1 else None
+        else:
+            png_file.seek(length, 1)
+        png_file.seek(4, 1) # CRC
+    if width is None:
+        raise ValueError('no PNG header')
+    return width, height, dpi, bool(interlaced)
+
+
+def probe_jpeg(jpg_file):
+    """
+        Width, height and dpi (None if not given) from the segments before the image data
+    """
+    dpi = None
+    while True:
+        byte = jpg_file.read(1)
+        if not byte:
+            raise ValueError('no JPEG frame header')
+        if byte != b'\xff':
+            continue
+        marker = jpg_file.read(1)[0]
+        if marker in (0xFF, 0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+            if marker == 0xFF:
+                jpg_file.seek(-1, 1) # fill byte
+            continue
+        if marker in (0xD9, 0xDA):
+            raise ValueError('no JPEG frame header')
+        length = struct.unpack('>H', jpg_file.read(2))[0]
+        if marker == 0xE0:
+            segment = jpg_file.read(length - 2)
+            if segment[:5] == b'JFIF\x00' and segment[7] in (1, 2):
+                density = struct.unpack('>H', segment[8:10])[0]
+                dpi = density if segment[7] == 1 else round(density * 2.54)
+        elif marker in (0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, \
+                0xCE, 0xCF):
+            height, width = struct.unpack('>xHH', jpg_file.read(5))
+            return width, height, dpi
+        else:
+            jpg_file.seek(length - 2, 1)
+
+
+def probe_pdf(pdf_file):
+    """
+        Width and height (in pt) of the first /MediaBox in the first or last 64 KiB,
+        (None, None) if it is elsewhere (e.g. in a compressed object stream)
+    """
+    import re
+    head = pdf_file.read(1 << 16)
+    pdf_file.seek(0, 2)
+    pdf_file.seek(max(pdf_file.tell() - (1 << 16), len(head)))
+    match = re.search(rb'/MediaBox\s*\[\s*([-\d.]+)\s+([-\d.]+)\s+([-\d.]+)\s+([-\d.]+)\s*\]', \
+        head + pdf_file.read())
+    if match is None:
+        return None, None, None
+    left, bottom, right, top = (float(value) for value in match.groups())
+    return right - left, top - bottom, None
+
+
+def probe_image(path):
+    """
+        Returns ImageInfo of an image, reading only its header
+    """
+    with open(path, 'rb') as image_file:
+        magic = image_file.read(8)
+        if magic == b'\x89PNG\r\n\x1a\n':
+            return ImageInfo('png', *probe_png(image_file))
+        if magic[:2] == b'\xff\xd8':
+            image_file.seek(2)
+            return ImageInfo('jpeg', *probe_jpeg(image_file), False)
+        if magic[:5] == b'%PDF-':
+            return ImageInfo('pdf', *probe_pdf(image_file), False)
+    raise ValueError('not a PNG, JPEG or PDF file')
+
+
+_ASSET_INDEXES = {}
+
+def index_assets(args, folder):
+    """
+        ImageInfo (or the error reading it) of every image in folder (-folder): file
+        name -> ImageInfo or str. Made again only if the folder's mtime changed; with
+        -cache, the index is kept in <cache>/assets for the next runs.
+    """
+    import json
+    import hashlib
+    folder = DIR_PATH/folder
+    mtime = os.stat(folder).st_mtime_ns
+    if _ASSET_INDEXES.get(folder, (None,))[0] == mtime:
+        return _ASSET_INDEXES[folder][1]
+
+    cachefile = None
+    cachedir = get_cachedir(args)
+    if cachedir is not None:
+        (cachedir/'assets').mkdir(exist_ok=True)
+        cachefile = cachedir/'assets'/(hashlib.sha256(str(folder).encode('utf8')).hexdigest()[:32] \
+            + '.json')
+        try:
+            with open(cachefile, 'r', encoding='utf8') as json_file:
+                cached = json.load(json_file)
+            if cached['mtime'] == mtime:
+                index = {name: value if isinstance(value, str) else ImageInfo(*value) \
+                    for name, value in cached['files'].items()}
+                _ASSET_INDEXES[folder] = (mtime, index)
+                return index
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    index = {}
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if not entry.name.endswith(IMAGE_EXTENSIONS) or not entry.is_file():
+                continue
+            try:
+                index[entry.name] = probe_image(entry.path)
+            except (OSError, ValueError, IndexError, struct.error) as err:
+                index[entry.name] = str(err) or type(err).__name__
+
+    _ASSET_INDEXES[folder] = (mtime, index)
+    if cachefile is not None:
+        tmpfile = cachefile.with_name(cachefile.name + f'.{os.getpid()}.tmp')
+        with open(tmpfile, 'w', encoding='utf8') as json_file:
+            json.dump({'mtime': mtime, 'files': index}, json_file)
+        os.replace(tmpfile, cachefile)
+    return index
+
+
+def check_assets(args):
+    """
+        Finds the front and back image of every bill value in the index of its folder,
+        before anything is made. Exits with all the problems found, including
+        images -backend pdf can't embed; images that would look blurry or
+        stretched are only reported.
+    """
+    # pylint: disable=too-many-locals,too-many-branches
+    import importlib.util
+    if args.d or args.pc:
+        return
+    # -dpi saves the PNG and JPEG images again (not interlaced), if Pillow is there
+    resampled = bool(args.dpi) and importlib.util.find_spec('PIL') is not None
+    width = float(args.width)
+    height = float(args.height)
+    errors = []
+    warnings = []
+    blurry = {}
+    for lbv in args.bv:
+        for image in dict.fromkeys(get_source_images(args, str(lbv))):
+            folder, _, name = image.rpartition('/')
+            index = index_assets(args, folder) if os.path.isdir(DIR_PATH/folder) else {}
+            found = [name + ext for ext in ('',) + IMAGE_EXTENSIONS if name + ext in index]
+            if not found:
+                errors.append(f'{image}: not found (bill value {lbv})')
+                continue
+            info = index[found[0]]
+            if isinstance(info, str):
+                errors.append(f'{folder}/{found[0]}: {info}')
+                continue
+            if args.backend == 'pdf' and info.kind == 'pdf':
+                errors.append(f'{folder}/{found[0]}: PDF images are not supported by '\
+                    '-backend pdf')
+            elif args.backend == 'pdf' and info.interlaced and not resampled:
+                errors.append(f'{folder}/{found[0]}: interlaced PNG images are not supported '\
+                    'by -backend pdf (save it without interlacing, or use -dpi)')
+            if info.width and info.height:
+                if abs(info.width / info.height / (width / height) - 1) > 0.05:
+                    warnings.append(f'{folder}/{found[0]}: {info.width:g}x'\
+                        f'{info.height:g} is stretched to {width:g}x{height:g} mm')
+                if info.kind != 'pdf' and info.width / (width / 25.4) < 150:
+                    blurry[f'{folder}/{found[0]}'] = info.width / (width / 25.4)
+
+    # the images in the default folder are for trying out, not for the print
+    if blurry and args.folder != get_defaults()['folder']:
+        warnings.append(f'{len(blurry)} image(s) are less than 150 dpi on the bill '\
+            f'and might look blurry: ' + ', '.join(f'{image} ({dpi:.0f} dpi)' \
+            for image, dpi in blurry.items()))
+    for warning in warnings:
+        print('Warning: ' + warning)
+    if errors:
+        print(f'Problems with the images in {args.folder}:')
+        for error in errors:
+            print('  ' + error)
+        sys.exit(1)
+
+
+# Times-Roman glyph widths (1/1000 em) for what can be in a serial number
+TIMES_WIDTHS = dict(zip('0123456789ABCDEF -', [500] * 10 + \
+    [722, 667, 667, 722, 611, 556, 250, 333]))
+
+# cap height of Times-Roman (1/1000 em), to center the label vertically
+TIMES_CAPHEIGHT = 662
+
+MM = 72 / 25.4 # PDF units (1/72 in) per mm
+
+
+def read_png(path):
+    """
+        Returns the image XObject (dictionary entries, stream) of a PNG file. The
+        compressed image data is used as is, except for images with an alpha channel,
+        whose alpha is split off into a soft mask.
+    """
+    # pylint: disable=too-many-locals,too-many-branches
+    with open(path, 'rb') as png_file:
+        data = png_file.read()
+    if data[:8] != b'\x89PNG\r\n\x1a\n':
+        raise ValueError(f'{path} is not a PNG file')
+
+    pos = 8
+    idat = []
+    palette = b''
+    trns = None
+    while pos < len(data):
+        length, ctype = struct.unpack('>I4s', data[pos:pos + 8])
+        chunk = data[pos + 8:pos + 8 + length]
+        pos += 12 + length
+        if ctype == b'IHDR':
+            width, height, bits, colortype, _, _, interlace = struct.unpack('>IIBBBBB', chunk)
+        elif ctype == b'PLTE':
+            palette = chunk
+        elif ctype == b'tRNS':
+            trns = chunk
+        elif ctype == b'IDAT':
+            idat.append(chunk)
+        elif ctype == b'IEND':
+            break
+
+    if interlace:
+        raise ValueError(f'{path}: interlaced PNG images are not supported by -backend pdf')
+
+    colors = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}[colortype]
+    entries = {'Type': '/XObject', 'Subtype': '/Image', 'Width': width, 'Height': height, \
+        'BitsPerComponent': bits}
+    if colortype == 3:
+        entries['ColorSpace'] = f'[/Indexed /DeviceRGB {len(palette) // 3 - 1} <{palette.hex()}>]'
+        if trns:
+            # transparent palette entries -> mask out the fully transparent ones
+            transparent = [str(i) for i, alpha in enumerate(trns) if alpha == 0]
+            if transparent:
+                entries['Mask'] = '[' + ' '.join(f'{i} {i}' for i in transparent) + ']'
+    else:
+        entries['ColorSpace'] = '/DeviceGray' if colortype in (0, 4) else '/DeviceRGB'
+
+    stream = b''.join(idat)
+    if colortype in (4, 6):
+        # split color and alpha: needs the unfiltered pixels
+        pixels = png_unfilter(zlib.decompress(stream), width, height, colors * bits // 8)
+        step = colors * bits // 8
+        alpha_size = bits // 8
+        color_size = step - alpha_size
+        color = bytearray()
+        alpha = bytearray()
+        for offset in range(0, len(pixels), step):
+            color += pixels[offset:offset + color_size]
+            alpha += pixels[offset + color_size:offset + step]
+        entries['SMask'] = ({'Type': '/XObject', 'Subtype': '/Image', 'Width': width, \
+            'Height': height, 'BitsPerComponent': bits, 'ColorSpace': '/DeviceGray', \
+            'Filter': '/FlateDecode'}, zlib.compress(bytes(alpha)))
+        entries['Filter'] = '/FlateDecode'
+        return entries, zlib.compress(bytes(color))
+
+    entries['Filter'] = '/FlateDecode'
+    entries['DecodeParms'] = f'<< /Predictor 15 /Colors {colors} /BitsPerComponent {bits} '\
+        f'/Columns {width} >>'
+    return entries, stream
+
+
+def png_unfilter(raw, width, height, bpp):
+    """
+        Undoes the PNG row filters (bpp: bytes per pixel, at least 1)
+    """
+    # pylint: disable=too-many-locals
+    stride = width * bpp
+    result = bytearray()
+    prior = bytearray(stride)
+    pos = 0
+    for _ in range(height):
+        ftype = raw[pos]
+        row = bytearray(raw[pos + 1:pos + 1 + stride])
+        pos += 1 + stride
+        if ftype == 1:
+            for i in range(bpp, stride):
+                row[i] = (row[i] + row[i - bpp]) & 0xFF
+        elif ftype == 2:
+            for i in range(stride):
+                row[i] = (row[i] + prior[i]) & 0xFF
+        elif ftype == 3:
+            for i in range(stride):
+                left = row[i - bpp] if i >= bpp else 0
+                row[i] = (row[i] + ((left + prior[i]) >> 1)) & 0xFF
+        elif ftype == 4:
+            for i in range(stride):
+                left = row[i - bpp] if i >= bpp else 0
+                upleft = prior[i - bpp] if i >= bpp else 0
+                estimate = left + prior[i] - upleft
+                dleft = abs(estimate - left)
+                dup = abs(estimate - prior[i])
+                dupleft = abs(estimate - upleft)
+                if dleft <= dup and dleft <= dupleft:
+                    row[i] = (row[i] + left) & 0xFF
+                elif dup <= dupleft:
+                    row[i] = (row[i] + prior[i]) & 0xFF
+                else:
+                    row[i] = (row[i] + upleft) & 0xFF
+        result += row
+        prior = row
+    return bytes(result)
+
+
+def read_jpeg(path):
+    """
+        Returns the image XObject (dictionary entries, stream) of a JPEG file
+    """
+    with open(path, 'rb') as jpg_file:
+        data = jpg_file.read()
+    if data[:2] != b'\xff\xd8':
+        raise ValueError(f'{path} is not a JPEG file')
+
+    pos = 2
+    adobe = False
+    while pos < len(data):
+        while data[pos] == 0xFF:
+            pos += 1
+        marker = data[pos]
+        pos += 1
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+            continue
+        length = struct.unpack('>H', data[pos:pos + 2])[0]
+        if marker == 0xEE and data[pos + 2:pos + 7] == b'Adobe':
+            adobe = True
+        if marker in (0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, \
+                0xCE, 0xCF):
+            bits, height, width, components = struct.unpack('>BHHB', data[pos + 2:pos + 8])
+            break
+        pos += length
+    else:
+        raise ValueError(f'{path}: no image size found')
+
+    colorspace = {1: '/DeviceGray', 3: '/DeviceRGB', 4: '/DeviceCMYK'}[components]
+    entries = {'Type': '/XObject', 'Subtype': '/Image', 'Width': width, 'Height': height, \
+        'BitsPerComponent': bits, 'ColorSpace': colorspace, 'Filter': '/DCTDecode'}
+    if components == 4 and adobe:
+        entries['Decode'] = '[1 0 1 0 1 0 1 0]'
+    return entries, data
+
+
+_IMAGE_OBJECTS = {}
+
+def read_image(path):
+    """
+        read_png or read_jpeg of path. Remembered for as long as size and mtime
+        don't change, so -batch jobs read every image only once.
+    """
+    stat = os.stat(path)
+    memo = (str(path), stat.st_size, stat.st_mtime_ns)
+    if memo not in _IMAGE_OBJECTS:
+        # forget older versions of the file
+        for old in [old for old in _IMAGE_OBJECTS if old[0] == memo[0]]:
+            _IMAGE_OBJECTS.pop(old, None)
+        if path.suffix.lower() == '.png':
+            _IMAGE_OBJECTS[memo] = read_png(path)
+        elif path.suffix.lower() in ('.jpg', '.jpeg'):
+            _IMAGE_OBJECTS[memo] = read_jpeg(path)
+        else:
+            raise ValueError(f'{path}: only PNG and JPEG images are supported by '\
+                '-backend pdf')
+    return _IMAGE_OBJECTS[memo]
+
+
+def pdf_string(text):
+    """
+        PDF string literal of text
+    """
+    return '(' + text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)') + ')'
+
+
+class PdfWriter:
+    """
+        Writes a PDF file, one object at a time. Every image is embedded once (as an
+        image XObject) and only referenced by the pages that show it.
+    """
+
+    def __init__(self, path):
+        self._out = open(path, 'wb') # pylint: disable=consider-using-with
+        self._offsets = [None] # object 0 is free
+        self._pages = []
+        self._images = {}
+        self._resources = {}
+        self._out.write(b'%PDF-1.5\n%\xe2\xe3\xcf\xd3\n')
+        self._pages_ref = self._reserve()
+        self._font_ref = self.add_object(b'<< /Type /Font /Subtype /Type1 '\
+            b'/BaseFont /Times-Roman /Encoding /WinAnsiEncoding >>')
+
+    def _reserve(self):
+        self._offsets.append(None)
+        return len(self._offsets) - 1
+
+    def add_object(self, data, ref=None):
+        """ writes an object and returns its number """
+        if ref is None:
+            ref = self._reserve()
+        self._offsets[ref] = self._out.tell()
+        self._out.write(f'{ref} 0 obj\n'.encode('ascii') + data + b'\nendobj\n')
+        return ref
+
+    def add_stream(self, entries, stream):
+        """ writes a stream object with the dictionary entries and returns its number """
+        entries = dict(entries)
+        for key, value in entries.items():
+            if isinstance(value, tuple):
+                entries[key] = f'{self.add_stream(*value)} 0 R'
+        head = ' '.join(f'/{key} {value}' for key, value in entries.items())
+        return self.add_object(f'<< {head} /Length {len(stream)} >>\nstream\n'.encode('ascii') \
+            + stream + b'\nendstream')
+
+    def image(self, path):
+        """ returns the resources (image as /Im, font as /F1) for a page showing path """
+        if path not in self._images:
+            if path is None:
+                self._images[path] = None
+            else:
+                self._images[path] = self.add_stream(*read_image(path))
+
+            xobject = '' if self._images[path] is None else \
+                f'/XObject << /Im {self._images[path]} 0 R >> '
+            self._resources[path] = self.add_object(f'<< {xobject}/Font << /F1 '\
+                f'{self._font_ref} 0 R >> >>'.encode('ascii'))
+        return self._resources[path]
+
+    def add_page(self, width, height, content, resources):
+        """ adds a page of width x height (PDF units) """
+        contents = self.add_stream({}, content)
+        self._pages.append(self.add_object(f'<< /Type /Page /Parent {self._pages_ref} 0 R '\
+            f'/MediaBox [0 0 {width:.3f} {height:.3f}] /Resources {resources} 0 R '\
+            f'/Contents {contents} 0 R >>'.encode('ascii')))
+
+    def add_pages_of(self, path):
+        """
+            Adds the pages of a PDF written by a PdfWriter, with the objects they use
+            (the page tree and catalog of the file are left out)
+        """
+        # pylint: disable=too-many-locals
+        import re
+        with open(path, 'rb') as pdf_file, \
+                mmap.mmap(pdf_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            xref = int(data[data.rfind(b'startxref') + 9:].split()[0])
+            table = data[xref:].split(b'\n')
+            offsets = [int(line[:10]) for line in table[3:2 + int(table[1].split()[1])]]
+            trailer = data[data.rfind(b'trailer'):]
+            catalog = int(re.search(rb'/Root (\d+) 0 R', trailer)[1])
+
+            def read(ref):
+                # (dictionary or object, stream or None) of object ref
+                start = data.find(b'\n', offsets[ref - 1]) + 1
+                end = data.find(b'\nendobj\n', start)
+                head = data.find(b'\nstream\n', start, end)
+                if head < 0:
+                    return data[start:end], None
+                length = int(re.search(rb'/Length (\d+)', data[start:head])[1])
+                return data[start:head], data[head + 8:head + 8 + length]
+
+            pages = int(re.search(rb'/Pages (\d+) 0 R', read(catalog)[0])[1])
+            kids = [int(ref) for ref in re.findall(rb'(\d+) 0 R', read(pages)[0])]
+            refs = {pages: self._pages_ref}
+            for ref in range(1, len(offsets) + 1):
+                if ref not in (catalog, pages):
+                    refs[ref] = self._reserve()
+            for ref, newref in refs.items():
+                if ref == pages:
+                    continue
+                head, stream = read(ref)
+                head = re.sub(rb'(\d+) 0 R', lambda match: b'%d 0 R' % refs[int(match[1])], head)
+                self.add_object(head if stream is None else \
+                    head + b'\nstream\n' + stream + b'\nendstream', newref)
+            self._pages += [refs[ref] for ref in kids]
+
+    def close(self):
+        """ writes page tree, catalog and cross reference table """
+        kids = ' '.join(f'{ref} 0 R' for ref in self._pages)
+        self.add_object(f'<< /Type /Pages /Kids [{kids}] /Count {len(self._pages)} >>'\
+            .encode('ascii'), self._pages_ref)
+        catalog = self.add_object(f'<< /Type /Catalog /Pages {self._pages_ref} 0 R >>'\
+            .encode('ascii'))
+
+        xref = self._out.tell()
+        self._out.write(f'xref\n0 {len(self._offsets)}\n'.encode('ascii'))
+        self._out.write(b'0000000000 65535 f \n')
+        for offset in self._offsets[1:]:
+            self._out.write(f'{offset:010d} 00000 n \n'.encode('ascii'))
+        self._out.write(f'trailer\n<< /Size {len(self._offsets)} /Root {catalog} 0 R >>\n'\
+            f'startxref\n{xref}\n%%EOF\n'.encode('ascii'))
+        self._out.close()
+
+
+def pdf_bill(xpos, ypos, width, height, image, label, xshift, yshift, fontsize):
+    """
+        Page content of one side of a bill at (xpos, ypos): the image, stretched to the
+        bill, and the label centered at (xshift, yshift) mm from the center of the bill.
+        An image that doesn't exist (e.g. -d) is drawn as a grey box.
+    """
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    if image is None:
+        content = f'q 0.85 g {xpos:.3f} {ypos:.3f} {width:.3f} {height:.3f} re f Q\n'
+    else:
+        content = f'q {width:.3f} 0 0 {height:.3f} {xpos:.3f} {ypos:.3f} cm /Im Do Q\n'
+
+    if label:
+        size = fontsize * MM
+        textwidth = sum(TIMES_WIDTHS.get(c, 500) for c in label) * size / 1000
+        xlabel = xpos + width / 2 + float(xshift) * MM - textwidth / 2
+        ylabel = ypos + height / 2 + float(yshift) * MM - TIMES_CAPHEIGHT * size / 2000
+        content += f'0 g BT /F1 {size:.3f} Tf {xlabel:.3f} {ylabel:.3f} Td '\
+            f'{pdf_string(label)} Tj ET\n'
+    return content.encode('latin-1')
+
+
+def get_bill_labels(args, lbv, snum):
+    """
+        Text printed on the front and back of a bill (no serial number: '')
+    """
+    front = '' if args.s else snum
+    if args.d:
+        front = lbv if args.s else lbv + ' -- ' + snum
+    back = '' if args.sb and not args.s else front
+    return front, back
+
+
+def create_pdf_main(args, file_bills, lstserial, unit=None):
+    """
+        Same as create_tex_main and compiling it, but writes the PDF directly:
+        one page per side of a bill, in the same order.
+    """
+    # pylint: disable=too-many-locals
+    xyf = Serialnumber(args)
+    width = float(args.width) * MM
+    height = float(args.height) * MM
+    padlen = len(str(args.sn[1]))
+
+    task = 'bills ' + Path(file_bills).stem
+    total = count_bills(args, unit)
+    done = 0
+    shared = get_shared_sides(args)
+
+    pdf = PdfWriter(file_bills)
+    for i, cntfirst, cntlast in get_bill_ranges(args, unit):
+        lbv = str(args.bv[i])
+        front, back = [find_image_file(image) for image in get_bill_images(args, lbv)]
+        front_res = pdf.image(front)
+        back_res = pdf.image(back)
+
+        # with shared sides, see plan_bill_pages
+        last = min(cntlast, cntfirst + 1) if 'front' in shared else cntlast
+        for scnt, serial in zip(range(cntfirst, last), iter_serials(lstserial, cntfirst, last)):
+            front_label, back_label = get_bill_labels(args, lbv, \
+                format_serial(args, serial, padlen))
+            pdf.add_page(width, height, pdf_bill(0, 0, width, height, \
+                front, front_label, xyf.shiftx, xyf.shifty, xyf.fontsize), front_res)
+            if scnt == cntfirst or not shared:
+                pdf.add_page(width, height, pdf_bill(0, 0, width, height, \
+                    back, back_label, xyf.shiftbx, xyf.shiftby, xyf.fontsize), back_res)
+
+            done += 1
+            if not done % PROGRESS_STEP:
+                args.progress.update(task, done, total)
+    pdf.close()
+    args.progress.finish(task, total)
+
+
+def get_paper_size(args):
+    """
+        Width and height of the (landscape) paper in mm
+    """
+    return max(PAPER_SIZES[args.ps]), min(PAPER_SIZES[args.ps])
+
+
+def iter_sheet_pages(args, lstserial, unit=None):
+    """
+        For -direct: yields every printed page (front, then back of each sheet) as
+        (image, bills), with bills a list of (x, y, front label, back label) in mm:
+        the lower left corner of the bill, from the lower left corner of the paper.
+        The bills are centered on the paper, as includepdf does; the back side is
+        shifted by -dupoff. image is the file name (as in get_bill_images).
+    """
+    # pylint: disable=too-many-locals
+    paperwidth, paperheight = get_paper_size(args)
+    width = float(args.width)
+    height = float(args.height)
+    ibpp = int(args.bpp)
+    icol = int(args.col)
+    rows, front_bills, back_bills = get_place_bills(ibpp, icol)
+
+    left = (paperwidth - icol * width) / 2
+    bottom = (paperheight - rows * height) / 2
+    corners = [(left + (place // rows) * width, bottom + (rows - 1 - place % rows) * height) \
+        for place in range(rows * icol)]
+    padlen = len(str(args.sn[1]))
+    dupx = float(args.dupoff[0])
+    dupy = float(args.dupoff[1])
+
+    for i, cntfirst, cntlast in get_bill_ranges(args, unit):
+        lbv = str(args.bv[i])
+        front, back = get_bill_images(args, lbv)
+
+        serials = iter_serials(lstserial, cntfirst, cntlast)
+        for _ in range(cntfirst, cntlast, ibpp):
+            labels = [get_bill_labels(args, lbv, format_serial(args, serial, padlen)) \
+                for serial in islice(serials, ibpp)]
+            yield front, [(x, y, labels[bill][0]) for (x, y), bill in zip(corners, front_bills) \
+                if bill is not None and bill < len(labels)]
+            yield back, [(x + dupx, y + dupy, labels[bill][1]) for (x, y), bill \
+                in zip(corners, back_bills) if bill is not None and bill < len(labels)]
+
+
+def create_pdf_sheets(args, file_sheets, lstserial, unit=None):
+    """
+        -direct with -backend pdf: writes the printable PDF right away
+    """
+    # pylint: disable=too-many-locals
+    xyf = Serialnumber(args)
+    paperwidth, paperheight = get_paper_size(args)
+    width = float(args.width) * MM
+    height = float(args.height) * MM
+
+    task = 'bills ' + Path(file_sheets).stem
+    total = count_bills(args, unit)
+    done = 0
+
+    pdf = PdfWriter(file_sheets)
+    side = 0
+    for image, bills in iter_sheet_pages(args, lstserial, unit):
+        imgfile = find_image_file(image)
+        shiftx, shifty = (xyf.shiftx, xyf.shifty) if side == 0 else (xyf.shiftbx, xyf.shiftby)
+        content = b''.join(pdf_bill(x * MM, y * MM, width, height, imgfile, label, \
+            shiftx, shifty, xyf.fontsize) for x, y, label in bills)
+        pdf.add_page(paperwidth * MM, paperheight * MM, content, pdf.image(imgfile))
+        if side == 0:
+            done += len(bills)
+            args.progress.update(task, done, total)
+        side = 1 - side
+    pdf.close()
+    args.progress.finish(task, total)
+
+
+def create_tex_sheets(args, file_sheets, lstserial, unit=None):
+    """
+        -direct with LaTeX: a document with the bills already put on the paper.
+        Images and labels are placed by the shipout/background hook (origin top left),
+        so one lualatex run is enough.
+    """
+    # pylint: disable=too-many-locals
+    xyf = Serialnumber(args)
+    paperheight = get_paper_size(args)[1]
+    width = float(args.width)
+    height = float(args.height)
+
+    out = open(file_sheets, 'w', encoding='utf8', newline='\n') # pylint: disable=consider-using-with
+    out.write(r'\documentclass{article}'+'\n')
+    out.write(r'\usepackage[landscape,' + args.ps + ', margin=0pt]{geometry}'+'\n')
+    out.write(r'\usepackage{graphicx}'+'\n')
+    print_fontsfamily(args, out, xyf)
+    print_billimg(args, out, f'width={width}mm, height={height}mm')
+    out.write(r'\newcommand{\billat}[6]{% x, y, image, x, y of label center, label'+'\n'\
+        r'  \AddToHookNext{shipout/background}{\setlength{\unitlength}{1mm}%'+'\n'\
+        r'    \put(#1,#2){\billimg{#3}}\put(#4,#5){\makebox(0,0){#6}}}}'+'\n')
+    out.write(r'\pagestyle{empty}'+'\n')
+    out.write(r'\begin{document}'+'\n')
+
+    task = 'bills ' + Path(file_sheets).stem
+    total = count_bills(args, unit)
+    done = 0
+
+    font = '' if args.s else r'\thisfontsfamily '
+    side = 0
+    for image, bills in iter_sheet_pages(args, lstserial, unit):
+        shiftx, shifty = (xyf.shiftx, xyf.shifty) if side == 0 else (xyf.shiftbx, xyf.shiftby)
+        for x, y, label in bills:
+            out.write(r'\billat{' + str(round(x, 3)) + '}{' + str(round(y - paperheight, 3)) + \
+                '}{' + image + '}{' + str(round(x + width / 2 + float(shiftx), 3)) + '}{' + \
+                str(round(y - paperheight + height / 2 + float(shifty), 3)) + '}{' + \
+                (font + label if label else '') + '}'+'\n')
+        out.write(r'\null\newpage'+'\n')
+        if side == 0:
+            done += len(bills)
+            args.progress.update(task, done, total)
+        side = 1 - side
+
+    out.write(r'\end{document}'+'\n')
+    out.close()
+    args.progress.finish(task, total)
+
+
+def cli(argv=None):
+    """
+        The command line: python make_money.py [options]
+    """
+    args, all_defargs, parser = argumentparser(argv)
+    if not (sys.argv[1:] if argv is None else argv):
+        # Print help, if no args are provided
+        parser.print_help(sys.stderr)
+        sys.exit(1)
+
+    if args.serve:
+        run_server(args, all_defargs, parser)
+    elif args.batch:
+        run_batch(args, all_defargs, parser)
+    elif args.worker:
+        run_worker(args, all_defargs, parser)
+    elif args.distribute:
+        run_coordinator(args, all_defargs, parser)
+    else:
+        main(args, all_defargs,)
 
-ARGS, ALL_DEFARGS, PARSER = argumentparser()
-if len(sys.argv)==1:
-    # Print help, if no args are provided
-    PARSER.print_help(sys.stderr)
-    sys.exit(1)
 
-main(ARGS, ALL_DEFARGS,)
+if __name__ == '__main__':
+    cli()
 
 # final endline